@@ -0,0 +1,7 @@
+"""benchmarks for the blog, run them from the repository root, e.g.
+python -m benchmarks.endpoints --output results.json
+python -m benchmarks.connections
+python -m benchmarks.serving
+python -m benchmarks.templates
+python -m benchmarks.compression
+"""
@@ -0,0 +1,87 @@
+"""database size and page_view latency with Page.content stored plain and compressed
+
+python -m benchmarks.compression [--pages 2000] [--words 200 3000]
+    [--requests 500] [--output results.json]
+
+Seeds pages with plain content, then measures, before and after converting
+them the way `main.py --compress-content --vacuum` does:
+
+database size   after a VACUUM, so it's the pages and not free space
+page_view       /page/<id> with the rendered page cache emptied before each
+                request, so every one loads the row and renders its content
+index           /index, whose listing rows never select the content column
+                (so it should not move, a regression check)
+
+Generated content comes from a small vocabulary and compresses better than
+real writing, so treat the size ratio as an upper bound.
+"""
+import os, sys, json, time, random, shutil, tempfile
+from argparse import ArgumentParser
+from benchmarks.harness import seed, latency_summary
+
+
+def measure(main, rows, args):
+  main.DB.execute_sql('VACUUM')
+  main.DB.close()
+  result = {'db_mb': os.path.getsize(main.DBPATH) / 1048576.0}
+  client = main.app.test_client()
+  rng = random.Random(args.seed)
+  latencies = []
+  for n in range(args.warmup + args.requests):
+    main.page_cache.clear()
+    started = time.time()
+    response = client.get('/page/{}'.format(rng.choice(rows['pages'])))
+    response.get_data()
+    assert response.status_code == 200, response.status_code
+    if n >= args.warmup:
+      latencies.append(time.time() - started)
+  result['page_view'] = latency_summary(latencies, sum(latencies))
+  latencies = []
+  for n in range(args.warmup + args.requests):
+    started = time.time()
+    response = client.get('/index')
+    response.get_data()
+    if n >= args.warmup:
+      latencies.append(time.time() - started)
+  result['index'] = latency_summary(latencies, sum(latencies))
+  main.DB.close()
+  return result
+
+
+def run(args):
+  workdir = tempfile.mkdtemp(prefix='blog-bench-')
+  # main reads these when imported, content starts out stored plain
+  os.environ['BLOG_DB_PATH'] = os.path.join(workdir, 'blog.db')
+  os.environ['BLOG_UPLOAD_FOLDER'] = os.path.join(workdir, 'uploads')
+  os.environ.pop('BLOG_COMPRESS_CONTENT', None)
+  sys.path.insert(0, os.getcwd())
+  import main
+  rows = seed(main, users=5, pages=args.pages, seed=args.seed, words=tuple(args.words))
+  results = {'plain': measure(main, rows, args)}
+  main.Page.content.enabled = True
+  started = time.time()
+  count = main.Page.recompress()
+  results['migration'] = {'pages': count, 'seconds': time.time() - started}
+  results['compressed'] = measure(main, rows, args)
+  print("migration: {} pages compressed in {:.1f}s".format(count, results['migration']['seconds']))
+  for label in ('plain', 'compressed'):
+    result = results[label]
+    print("{:<11} db {:>7.2f} MB   page_view p50 {:>6.2f} p95 {:>6.2f} ms   index p50 {:>6.2f} ms".format(
+      label, result['db_mb'], result['page_view']['p50_ms'], result['page_view']['p95_ms'],
+      result['index']['p50_ms']))
+  if args.output:
+    with open(args.output, 'w') as fp:
+      json.dump(results, fp, indent=2, sort_keys=True)
+  shutil.rmtree(workdir, ignore_errors=True)
+  return results
+
+
+if __name__ == '__main__':
+  parser = ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--pages', type=int, default=2000)
+  parser.add_argument('--words', type=int, nargs=2, default=[200, 3000], help='min and max words per page')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--requests', type=int, default=500, help='timed requests per endpoint')
+  parser.add_argument('--warmup', type=int, default=50, help='untimed requests per endpoint first')
+  parser.add_argument('--output', help='write the results as JSON to this file')
+  run(parser.parse_args())
@@ -0,0 +1,97 @@
+"""requests/sec with concurrent readers for each database connection mode
+
+python -m benchmarks.connections [--pages 2000] [--clients 8] [--seconds 10] [--no-writer]
+
+Each configuration runs in its own process (main reads BLOG_DB_MODE and
+BLOG_DB_PRAGMAS when imported) against a freshly seeded database in a temp
+directory, served by a werkzeug server with a fixed pool of worker threads
+(like a production server, so per-thread connections actually get reused).
+Reader threads fetch /index and /search while, unless --no-writer, one
+thread keeps saving a page so readers contend with a writer.
+"""
+import os, sys, json, time, tempfile, threading, subprocess, urllib2
+from argparse import ArgumentParser
+from benchmarks.harness import seed, serve
+
+CONFIGS = [
+  ('before (request, default pragmas)', {'BLOG_DB_MODE': 'request', 'BLOG_DB_PRAGMAS': 'off'}),
+  ('request + pragmas', {'BLOG_DB_MODE': 'request'}),
+  ('thread + pragmas', {'BLOG_DB_MODE': 'thread'}),
+  ('pool + pragmas', {'BLOG_DB_MODE': 'pool'}),
+]
+READ_URLS = ['/index', '/search?s=benchmark']
+WORKERS = 8
+
+
+def hammer(base_url, clients, seconds, writer, main):
+  """run reader threads (and a writer) for seconds, returns completed reads"""
+  deadline = time.time() + seconds
+  counts = [0] * clients
+  errors = [0]
+  
+  def read(n):
+    i = 0
+    while time.time() < deadline:
+      try:
+        urllib2.urlopen(base_url + READ_URLS[i % len(READ_URLS)]).read()
+        counts[n] += 1
+      except Exception:
+        errors[0] += 1
+      i += 1
+  
+  def write():
+    while time.time() < deadline:
+      page = main.Page.get()
+      page.title = 'Benchmark page written at {}'.format(time.time())
+      page.save()
+      time.sleep(0.01)
+    main.DB.close()
+  
+  threads = [threading.Thread(target=read, args=(n,)) for n in range(clients)]
+  if writer:
+    threads.append(threading.Thread(target=write))
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  return sum(counts), errors[0]
+
+
+def child(args):
+  """one configuration, prints a JSON result line"""
+  sys.path.insert(0, os.getcwd())
+  import main
+  seed(main, pages=args.pages)
+  base_url = serve(main.app, WORKERS)
+  reads, errors = hammer(base_url, args.clients, args.seconds, not args.no_writer, main)
+  print(json.dumps({'requests': reads, 'errors': errors, 'rps': reads / float(args.seconds)}))
+
+
+def run(args):
+  results = []
+  for label, env in CONFIGS:
+    workdir = tempfile.mkdtemp(prefix='blog-bench-')
+    child_env = dict(os.environ, BLOG_DB_PATH=os.path.join(workdir, 'blog.db'), **env)
+    command = [sys.executable, '-m', 'benchmarks.connections', '--child',
+               '--pages', str(args.pages), '--clients', str(args.clients),
+               '--seconds', str(args.seconds)] + (['--no-writer'] if args.no_writer else [])
+    output = subprocess.check_output(command, env=child_env)
+    result = json.loads(output.strip().splitlines()[-1])
+    results.append((label, result))
+    print("{:<36} {:>8.1f} req/s  ({} requests, {} errors)".format(
+      label, result['rps'], result['requests'], result['errors']))
+  return results
+
+
+if __name__ == '__main__':
+  parser = ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--pages', type=int, default=2000)
+  parser.add_argument('--clients', type=int, default=8)
+  parser.add_argument('--seconds', type=float, default=10)
+  parser.add_argument('--no-writer', action='store_true')
+  parser.add_argument('--child', action='store_true', help='(internal) run one configuration')
+  args = parser.parse_args()
+  if args.child:
+    child(args)
+  else:
+    run(args)
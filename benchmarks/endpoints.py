@@ -0,0 +1,166 @@
+"""latency, throughput and SQL count for the hot read endpoints
+
+python -m benchmarks.endpoints [--users 50] [--pages 2000] [--files 200]
+    [--requests 300] [--clients 8] [--seconds 5] [--mode both]
+    [--output results.json] [--compare baseline.json]
+
+A database is seeded in a temp directory (see harness.seed, the same --seed
+gives the same rows and the same request sequence), then each endpoint is
+driven two ways:
+
+test client - --requests sequential requests through app.test_client(),
+              timing each and counting its SQL statements
+wsgi        - --clients threads against a pooled werkzeug server for
+              --seconds, for latency under concurrency and throughput
+
+Results are printed and, with --output, written as JSON so runs from two
+releases can be diffed; --compare prints the change against such a file.
+BLOG_DB_MODE / BLOG_DB_PRAGMAS are honoured as usual.
+"""
+import os, sys, json, time, random, tempfile, subprocess, platform, sqlite3, urllib2
+from argparse import ArgumentParser
+from benchmarks.harness import seed, serve, load, latency_summary
+
+SEARCH_TERMS = ['lorem', 'dolor amet', 'benchmark', 'tempor incididunt', 'magna aliqua']
+
+# name -> function (rng, seeded rows) returning the next url to request
+ENDPOINTS = [
+  ('index', lambda rng, rows: '/index'),
+  ('page_view', lambda rng, rows: '/page/{}'.format(rng.choice(rows['pages']))),
+  ('site', lambda rng, rows: '/' + rng.choice(rows['slugs'])),
+  ('search', lambda rng, rows: '/search?s=' + urllib2.quote(rng.choice(SEARCH_TERMS))),
+  ('file_uploads', lambda rng, rows: '/uploads/' + rng.choice(rows['files'])),
+]
+SUMMARY_FIELDS = ['p50_ms', 'p95_ms', 'p99_ms', 'rps', 'sql_mean']
+
+
+def endpoints(rows):
+  """the endpoints there are rows for"""
+  return [(name, url) for name, url in ENDPOINTS if name != 'file_uploads' or rows['files']]
+
+
+def run_test_client(main, rows, requests, warmup, seed_value):
+  """sequential requests through the test client, with SQL counts"""
+  from utils import QueryCounter
+  client = main.app.test_client()
+  results = {}
+  for name, next_url in endpoints(rows):
+    rng = random.Random(seed_value)
+    for _ in range(warmup):
+      client.get(next_url(rng, rows)).close()
+    latencies, sql_counts, errors = [], [], 0
+    started = time.time()
+    for _ in range(requests):
+      url = next_url(rng, rows)
+      with QueryCounter(main.DB) as counter:
+        request_started = time.time()
+        response = client.get(url)
+        response.get_data()
+        latency = time.time() - request_started
+        response.close()
+      if response.status_code != 200:
+        errors += 1
+        continue
+      latencies.append(latency)
+      sql_counts.append(counter.count)
+    result = latency_summary(latencies, time.time() - started, errors)
+    result['sql_mean'] = sum(sql_counts) / float(len(sql_counts)) if sql_counts else 0.0
+    result['sql_max'] = max(sql_counts) if sql_counts else 0
+    results[name] = result
+  return results
+
+
+def run_wsgi(main, rows, clients, seconds, workers, seed_value):
+  """concurrent clients against a real server, per endpoint in turn"""
+  base_url = serve(main.app, workers)
+  results = {}
+  for name, next_url in endpoints(rows):
+    latencies, errors, elapsed = load(base_url, lambda rng: next_url(rng, rows), clients, seconds, seed_value)
+    results[name] = latency_summary(latencies, elapsed, errors)
+  return results
+
+
+def environment(args):
+  """what the numbers were measured on, stored with them"""
+  try:
+    revision = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=open(os.devnull, 'w')).strip()
+  except (OSError, subprocess.CalledProcessError):
+    revision = None
+  import flask, peewee
+  return {
+    'revision': revision,
+    'at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'sqlite': sqlite3.sqlite_version,
+    'flask': flask.__version__,
+    'peewee': peewee.__version__,
+    'db_mode': os.environ.get('BLOG_DB_MODE', ''),
+    'args': vars(args),
+  }
+
+
+def report(results, baseline=None):
+  """print a table per phase, with the change against a baseline run if given"""
+  for phase in ('test_client', 'wsgi'):
+    if phase not in results:
+      continue
+    print("\n{}".format(phase))
+    print("{:<14}".format('endpoint') + ''.join("{:>14}".format(f) for f in SUMMARY_FIELDS))
+    for name, stats in sorted(results[phase].items()):
+      line = "{:<14}".format(name)
+      before = (baseline or {}).get(phase, {}).get(name, {})
+      for field in SUMMARY_FIELDS:
+        if field not in stats:
+          line += "{:>14}".format("-")
+        elif before.get(field):
+          line += "{:>14}".format("{:.1f} {:+.0f}%".format(
+            stats[field], 100.0 * (stats[field] - before[field]) / before[field]))
+        else:
+          line += "{:>14.1f}".format(stats[field])
+      if stats['errors']:
+        line += "  ({} errors)".format(stats['errors'])
+      print(line)
+
+
+def run(args):
+  workdir = tempfile.mkdtemp(prefix='blog-bench-')
+  # main reads its database path when imported
+  os.environ['BLOG_DB_PATH'] = os.path.join(workdir, 'blog.db')
+  sys.path.insert(0, os.getcwd())
+  import main
+  main.app.config['UPLOAD_FOLDER'] = os.path.join(workdir, 'uploads')
+  rows = seed(main, users=args.users, pages=args.pages, files=args.files, seed=args.seed)
+  results = {'environment': environment(args)}
+  if args.mode in ('both', 'client'):
+    results['test_client'] = run_test_client(main, rows, args.requests, args.warmup, args.seed)
+    main.DB.close()
+  if args.mode in ('both', 'wsgi'):
+    results['wsgi'] = run_wsgi(main, rows, args.clients, args.seconds, args.workers, args.seed)
+  baseline = None
+  if args.compare:
+    with open(args.compare) as fp:
+      baseline = json.load(fp)
+  report(results, baseline)
+  if args.output:
+    with open(args.output, 'w') as fp:
+      json.dump(results, fp, indent=2, sort_keys=True)
+  return results
+
+
+if __name__ == '__main__':
+  parser = ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--users', type=int, default=50)
+  parser.add_argument('--pages', type=int, default=2000)
+  parser.add_argument('--files', type=int, default=200)
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--mode', choices=('both', 'client', 'wsgi'), default='both')
+  parser.add_argument('--requests', type=int, default=300, help='test client requests per endpoint')
+  parser.add_argument('--warmup', type=int, default=20, help='untimed test client requests per endpoint')
+  parser.add_argument('--clients', type=int, default=8, help='concurrent wsgi clients')
+  parser.add_argument('--workers', type=int, default=8, help='wsgi server threads')
+  parser.add_argument('--seconds', type=float, default=5, help='wsgi run time per endpoint')
+  parser.add_argument('--output', help='write the results as JSON to this file')
+  parser.add_argument('--compare', help='a previous --output file to compare against')
+  run(parser.parse_args())
@@ -0,0 +1,154 @@
+"""shared pieces for the benchmarks: seeding a database, serving the app on a
+pooled werkzeug server and summarizing latencies
+"""
+import os, math, time, random, threading, urllib2, Queue
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod '
+         'tempor incididunt ut labore et dolore magna aliqua benchmark').split()
+
+
+def seed(main, users=1, pages=2000, files=0, seed=0, words=(50, 400)):
+  """create tables and fill them with generated rows, deterministic for a seed.
+  User 1 is an admin ('admin'/'admin'), pages get slugs bench-<n> and between
+  words[0] and words[1] words of content, files are small stored uploads under
+  the app's UPLOAD_FOLDER.
+  returns {'users': [ids], 'pages': [ids], 'slugs': [slugs], 'files': [paths]}
+  """
+  rng = random.Random(seed)
+  main.DB.create_tables([main.BlogMeta, main.User, main.Page, main.PageIndex, main.File,
+                        main.RateBucket], safe=True)
+  main.get_blog_meta()
+  main.User.create_user('admin', 'admin', is_admin=True)
+  # one hash for everybody else, werkzeug hashing is far slower than the inserts
+  password = main.hash_password('benchmark', main.PASSWORD_METHOD, main.PASSWORD_SALT_LENGTH)
+  user_rows = [{'username': 'user{}'.format(i), 'password': password} for i in range(1, users)]
+  with main.DB.atomic():
+    for i in range(0, len(user_rows), 100):
+      main.User.insert_many(user_rows[i:i + 100]).execute()
+  user_ids = [u.id for u in main.User.select(main.User.id).order_by(main.User.id)]
+
+  page_rows = []
+  for i in range(pages):
+    body = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(*words)))
+    page_rows.append({'author': rng.choice(user_ids), 'title': 'Benchmark page {}'.format(i),
+                      'slug': 'bench-{}'.format(i), 'content': '<p>{}</p>'.format(body)})
+  with main.DB.atomic():
+    for i in range(0, len(page_rows), 100):
+      main.Page.insert_many(page_rows[i:i + 100]).execute()
+  # insert_many bypasses Page.save(), which derives summaries and indexes for search
+  main.Page.backfill_text()
+  main.PageIndex.reindex_all()
+  main.reload_slug_map()
+
+  upload_folder = main.app.config['UPLOAD_FOLDER']
+  file_rows = []
+  for i in range(files):
+    filepath = os.path.join('bench', '{:04d}'.format(i), 'file{}.txt'.format(i))
+    data = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(100, 2000)))
+    main.storage.ensure_dir(os.path.dirname(os.path.join(upload_folder, filepath)))
+    with open(os.path.join(upload_folder, filepath), 'w') as fp:
+      fp.write(data)
+    file_rows.append({'title': 'file{}.txt'.format(i), 'filepath': filepath,
+                      'owner': rng.choice(user_ids), 'size': len(data)})
+  with main.DB.atomic():
+    for i in range(0, len(file_rows), 100):
+      main.File.insert_many(file_rows[i:i + 100]).execute()
+
+  seeded = {
+    'users': user_ids,
+    'pages': [p.id for p in main.Page.select(main.Page.id).order_by(main.Page.id)],
+    'slugs': [row['slug'] for row in page_rows],
+    'files': [row['filepath'] for row in file_rows],
+  }
+  main.DB.close()
+  return seeded
+
+
+def serve(app, workers=8):
+  """start app on a pooled server in the background, returns its base url"""
+  from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+  class QuietHandler(WSGIRequestHandler):
+    def log_request(self, *args):
+      pass
+
+  class PooledWSGIServer(BaseWSGIServer):
+    """handles requests on a fixed number of long-lived threads"""
+    def __init__(self, *args, **kwargs):
+      BaseWSGIServer.__init__(self, *args, **kwargs)
+      self.pending = Queue.Queue()
+      for _ in range(workers):
+        worker = threading.Thread(target=self.work)
+        worker.daemon = True
+        worker.start()
+
+    def process_request(self, request, client_address):
+      self.pending.put((request, client_address))
+
+    def work(self):
+      while True:
+        request, client_address = self.pending.get()
+        try:
+          self.finish_request(request, client_address)
+        except Exception:
+          self.handle_error(request, client_address)
+        finally:
+          self.shutdown_request(request)
+
+  server = PooledWSGIServer('127.0.0.1', 0, app, handler=QuietHandler)
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  return 'http://127.0.0.1:{}'.format(server.server_port)
+
+
+def load(base_url, next_url, clients, seconds, seed=0):
+  """clients threads requesting base_url + next_url(rng) for seconds
+  returns ([latency of each successful request], errors, elapsed seconds)
+  """
+  latencies = [[] for _ in range(clients)]
+  errors = [0] * clients
+  deadline = time.time() + seconds
+
+  def hammer(n):
+    rng = random.Random(seed + n)
+    while time.time() < deadline:
+      started = time.time()
+      try:
+        urllib2.urlopen(base_url + next_url(rng)).read()
+      except Exception:
+        errors[n] += 1
+        continue
+      latencies[n].append(time.time() - started)
+
+  threads = [threading.Thread(target=hammer, args=(n,)) for n in range(clients)]
+  started = time.time()
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  return sum(latencies, []), sum(errors), time.time() - started
+
+
+def percentile(ordered, q):
+  """nearest-rank percentile of an already sorted list"""
+  if not ordered:
+    return 0.0
+  rank = int(math.ceil(q / 100.0 * len(ordered)))
+  return ordered[min(max(rank, 1), len(ordered)) - 1]
+
+
+def latency_summary(latencies, elapsed, errors=0):
+  """p50/p95/p99/mean/max in milliseconds and requests per second"""
+  ordered = sorted(latencies)
+  count = len(ordered)
+  return {
+    'requests': count,
+    'errors': errors,
+    'rps': count / elapsed if elapsed else 0.0,
+    'mean_ms': 1000 * sum(ordered) / count if count else 0.0,
+    'p50_ms': 1000 * percentile(ordered, 50),
+    'p95_ms': 1000 * percentile(ordered, 95),
+    'p99_ms': 1000 * percentile(ordered, 99),
+    'max_ms': 1000 * ordered[-1] if ordered else 0.0,
+  }
@@ -0,0 +1,130 @@
+"""requests/sec and latency of the read endpoints under each way of serving the app
+
+python -m benchmarks.serving [--pages 2000] [--files 200] [--clients 32]
+    [--seconds 10] [--warmup 3] [--workers N] [--threads 4] [--output results.json]
+
+Seeds one database (see harness.seed), then for each server configuration
+starts it as a separate process and drives a mix of index, page_view, site,
+search and file_uploads requests from client processes (so the load
+generator isn't stuck behind one GIL either):
+
+app.run()          the development server main.py runs (one process, a thread per request)
+gunicorn sync      --workers processes, one request at a time each
+gunicorn gthread   --workers processes x --threads threads (gunicorn.conf.py)
+
+The multi-process servers only pull ahead with several cores to run on,
+the environment section of the results records how many there were.
+"""
+import os, sys, json, time, socket, tempfile, subprocess, multiprocessing, urllib2
+from argparse import ArgumentParser
+from benchmarks.harness import seed, load, latency_summary
+from benchmarks.endpoints import endpoints
+
+DEV_SERVER = "import main; main.app.run(host='127.0.0.1', port={port})"
+
+
+def configs(args):
+  """(label, command) of each server, {port} is filled in"""
+  gunicorn = [sys.executable, '-m', 'gunicorn.app.wsgiapp', '-c', 'gunicorn.conf.py',
+              '--bind', '127.0.0.1:{port}', '--workers', str(args.workers)]
+  return [
+    ('app.run()', [sys.executable, '-c', DEV_SERVER]),
+    ('gunicorn sync x{}'.format(args.workers), gunicorn + ['--worker-class', 'sync', 'wsgi:application']),
+    ('gunicorn gthread x{}x{}'.format(args.workers, args.threads),
+     gunicorn + ['--threads', str(args.threads), 'wsgi:application']),
+  ]
+
+
+def free_port():
+  sock = socket.socket()
+  sock.bind(('127.0.0.1', 0))
+  port = sock.getsockname()[1]
+  sock.close()
+  return port
+
+
+def wait_until_up(base_url, process, timeout=30):
+  deadline = time.time() + timeout
+  while time.time() < deadline:
+    if process.poll() is not None:
+      raise RuntimeError('server exited with {}'.format(process.returncode))
+    try:
+      urllib2.urlopen(base_url + '/index').read()
+      return
+    except Exception:
+      time.sleep(0.2)
+  raise RuntimeError('server did not come up within {} seconds'.format(timeout))
+
+
+def client_process(job):
+  """one load generator process, a share of the clients"""
+  base_url, rows, clients, seconds, seed_value = job
+  mix = endpoints(rows)
+  def next_url(rng):
+    return rng.choice(mix)[1](rng, rows)
+  return load(base_url, next_url, clients, seconds, seed_value)
+
+
+def drive(base_url, rows, args, seconds):
+  processes = max(1, min(args.client_processes, args.clients))
+  jobs = [(base_url, rows, args.clients // processes + (n < args.clients % processes),
+           seconds, args.seed + 1000 * n) for n in range(processes)]
+  pool = multiprocessing.Pool(processes)
+  try:
+    parts = pool.map(client_process, jobs)
+  finally:
+    pool.close()
+    pool.join()
+  latencies = sum((part[0] for part in parts), [])
+  return latency_summary(latencies, max(part[2] for part in parts), sum(part[1] for part in parts))
+
+
+def run(args):
+  workdir = tempfile.mkdtemp(prefix='blog-bench-')
+  # the servers inherit these, main reads them when imported
+  os.environ['BLOG_DB_PATH'] = os.path.join(workdir, 'blog.db')
+  os.environ['BLOG_UPLOAD_FOLDER'] = os.path.join(workdir, 'uploads')
+  sys.path.insert(0, os.getcwd())
+  import main
+  rows = seed(main, users=args.users, pages=args.pages, files=args.files, seed=args.seed)
+  results = {'environment': {'cpus': multiprocessing.cpu_count(), 'args': vars(args),
+                             'at': time.strftime('%Y-%m-%dT%H:%M:%S')},
+             'servers': {}}
+  devnull = open(os.devnull, 'w')
+  for label, command in configs(args):
+    port = free_port()
+    base_url = 'http://127.0.0.1:{}'.format(port)
+    process = subprocess.Popen([part.format(port=port) for part in command],
+                               stdout=devnull, stderr=devnull)
+    try:
+      wait_until_up(base_url, process)
+      # untimed, so every worker has opened its connection and filled its caches
+      drive(base_url, rows, args, args.warmup)
+      result = drive(base_url, rows, args, args.seconds)
+    finally:
+      process.terminate()
+      process.wait()
+    results['servers'][label] = result
+    print("{:<24} {:>8.1f} req/s  p50 {:>7.1f} ms  p95 {:>7.1f} ms  p99 {:>7.1f} ms  ({} errors)".format(
+      label, result['rps'], result['p50_ms'], result['p95_ms'], result['p99_ms'], result['errors']))
+  if args.output:
+    with open(args.output, 'w') as fp:
+      json.dump(results, fp, indent=2, sort_keys=True)
+  return results
+
+
+if __name__ == '__main__':
+  cpus = multiprocessing.cpu_count()
+  parser = ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--users', type=int, default=50)
+  parser.add_argument('--pages', type=int, default=2000)
+  parser.add_argument('--files', type=int, default=200)
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--clients', type=int, default=32, help='concurrent clients in all')
+  parser.add_argument('--client-processes', type=int, default=cpus, help='processes the clients run in')
+  parser.add_argument('--seconds', type=float, default=10, help='run time per server')
+  parser.add_argument('--warmup', type=float, default=3, help='untimed seconds per server first')
+  parser.add_argument('--workers', type=int, default=cpus * 2 + 1, help='gunicorn worker processes')
+  parser.add_argument('--threads', type=int, default=4, help='threads per gthread worker')
+  parser.add_argument('--output', help='write the results as JSON to this file')
+  run(parser.parse_args())
@@ -0,0 +1,123 @@
+"""cold start and per-render cost of the templates
+
+python -m benchmarks.templates [--runs 5] [--renders 500]
+
+Cold start: each configuration starts fresh processes (--runs of them) that
+import main, optionally compile_templates() as wsgi.py does, then time the
+first /index, /page/<id> and /search through the test client:
+
+no bytecode cache            BLOG_TEMPLATE_CACHE=off, compiled on first use
+bytecode cache, empty        the first worker after a deploy
+bytecode cache, filled       later workers / restarts
+filled + compile at startup  wsgi.py, first requests find everything loaded
+
+Per render: index.html rendered --renders times in one process with jinja's
+auto_reload on (the template files are stat'ed on every render) and off.
+"""
+import os, sys, json, time, shutil, tempfile, subprocess
+from argparse import ArgumentParser
+from benchmarks.harness import seed
+
+FIRST_URLS = ['/index', '/page/1', '/search?s=lorem']
+
+
+def child(args):
+  """one fresh process, prints a JSON result line"""
+  started = time.time()
+  sys.path.insert(0, os.getcwd())
+  import main
+  if args.precompile:
+    main.compile_templates()
+  startup = time.time() - started
+  client = main.app.test_client()
+  first = {}
+  for url in FIRST_URLS:
+    request_started = time.time()
+    response = client.get(url)
+    response.get_data()
+    first[url] = time.time() - request_started
+    assert response.status_code == 200, (url, response.status_code)
+  print(json.dumps({'startup': startup, 'first': first}))
+
+
+def median(values):
+  ordered = sorted(values)
+  return ordered[len(ordered) // 2]
+
+
+def cold_start(args, workdir):
+  cache_dir = os.path.join(workdir, 'jinja')
+  configs = [
+    ('no bytecode cache', 'off', False, False),
+    ('bytecode cache, empty', cache_dir, False, True),
+    ('bytecode cache, filled', cache_dir, False, False),
+    ('filled + compile at startup', cache_dir, True, False),
+  ]
+  results = {}
+  for label, cache, precompile, empty_first in configs:
+    runs = []
+    for _ in range(args.runs):
+      if empty_first:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+      command = [sys.executable, '-m', 'benchmarks.templates', '--child'] + (['--precompile'] if precompile else [])
+      output = subprocess.check_output(command, env=dict(os.environ, BLOG_TEMPLATE_CACHE=cache))
+      runs.append(json.loads(output.strip().splitlines()[-1]))
+    result = {'startup_ms': 1000 * median([run['startup'] for run in runs])}
+    for url in FIRST_URLS:
+      result[url] = 1000 * median([run['first'][url] for run in runs])
+    result['first_requests_ms'] = sum(result[url] for url in FIRST_URLS)
+    results[label] = result
+    print("{:<30} startup {:>7.1f} ms   first requests {:>7.1f} ms  ({})".format(
+      label, result['startup_ms'], result['first_requests_ms'],
+      ', '.join('{} {:.1f}'.format(url, result[url]) for url in FIRST_URLS)))
+  return results
+
+
+def per_render(args):
+  sys.path.insert(0, os.getcwd())
+  import main
+  results = {}
+  with main.app.test_request_context('/index'):
+    main.before_request()
+    pages = [main.PageRow.from_tuple(row) for row in main.PageRow.select().limit(main.INDEX_PAGE_SIZE).tuples()]
+    for auto_reload in (True, False):
+      main.app.jinja_env.auto_reload = auto_reload
+      main.render_template('index.html', pages=pages, blog=main.g.blog, next_cursor=None)
+      started = time.time()
+      for _ in range(args.renders):
+        main.render_template('index.html', pages=pages, blog=main.g.blog, next_cursor=None)
+      label = 'auto_reload {}'.format('on' if auto_reload else 'off')
+      results[label] = 1e6 * (time.time() - started) / args.renders
+      print("index.html render, {:<16} {:>8.1f} us".format(label, results[label]))
+  return results
+
+
+def run(args):
+  workdir = tempfile.mkdtemp(prefix='blog-bench-')
+  # children inherit these, main reads them when imported
+  os.environ['BLOG_DB_PATH'] = os.path.join(workdir, 'blog.db')
+  os.environ['BLOG_UPLOAD_FOLDER'] = os.path.join(workdir, 'uploads')
+  os.environ['BLOG_TEMPLATE_CACHE'] = 'off'
+  sys.path.insert(0, os.getcwd())
+  import main
+  seed(main, users=5, pages=200)
+  results = {'cold_start': cold_start(args, workdir), 'per_render_us': per_render(args)}
+  if args.output:
+    with open(args.output, 'w') as fp:
+      json.dump(results, fp, indent=2, sort_keys=True)
+  shutil.rmtree(workdir, ignore_errors=True)
+  return results
+
+
+if __name__ == '__main__':
+  parser = ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--runs', type=int, default=5, help='fresh processes per configuration')
+  parser.add_argument('--renders', type=int, default=500)
+  parser.add_argument('--output', help='write the results as JSON to this file')
+  parser.add_argument('--child', action='store_true', help='(internal) one fresh process')
+  parser.add_argument('--precompile', action='store_true', help='(internal) compile_templates() first')
+  args = parser.parse_args()
+  if args.child:
+    child(args)
+  else:
+    run(args)
@@ -0,0 +1,139 @@
+"""response compression: gzip, and brotli when it's installed, picked from the
+client's Accept-Encoding.
+
+compressor = ResponseCompressor(mimetypes, min_size)
+compressor.install(app)
+
+Responses of the given mimetypes are compressed after the view ran, streamed
+ones chunk by chunk. Bodies that are cached anyway (rendered pages, feeds)
+should go through compressor.cached(), which keeps each encoding's bytes in
+the cache entry so a hit costs no compression, and stored uploads through
+compressor.send_file(), which keeps them as the upload's <encoding> variant
+(see storage.variant_path, out of the way of uploaded names).
+"""
+import os, zlib
+from flask import request, send_file
+import storage
+
+try:
+  import brotli
+except ImportError:
+  # optional, without it only gzip is offered
+  brotli = None
+
+# preferred first, when the client accepts both equally
+ENCODINGS = ['br', 'gzip'] if brotli else ['gzip']
+# every encoding a stored upload may have a variant for
+FILE_ENCODINGS = ['br', 'gzip']
+
+
+def compress(data, encoding, level=6):
+  if encoding == 'br':
+    return brotli.compress(data, quality=level)
+  compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+  return compressor.compress(data) + compressor.flush()
+
+def compress_chunks(chunks, encoding, level=6):
+  """compress a stream of byte chunks incrementally, flushing after each one
+  so the client gets data as soon as the view yields it"""
+  if encoding == 'br':
+    compressor = brotli.Compressor(quality=level)
+    for chunk in chunks:
+      data = compressor.process(chunk) + compressor.flush()
+      if data:
+        yield data
+    yield compressor.finish()
+  else:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+      data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+      if data:
+        yield data
+    yield compressor.flush()
+
+
+class ResponseCompressor(object):
+  """compresses responses for clients that accept it, see the module docstring.
+  level is gzip's (1-9), brotli_level brotli's quality (0-11).
+  """
+  def __init__(self, mimetypes, min_size=1024, level=6, brotli_level=5, enabled=True):
+    self.mimetypes = set(mimetypes)
+    self.min_size = min_size
+    self.level = level
+    self.brotli_level = brotli_level
+    self.enabled = enabled
+
+  def install(self, app):
+    app.after_request(self._after_request)
+
+  def negotiate(self, mimetype, size=None):
+    """the encoding to send a body of this type (and size, if known) in, or None"""
+    if not self.enabled or mimetype not in self.mimetypes:
+      return None
+    if size is not None and size < self.min_size:
+      return None
+    return request.accept_encodings.best_match(ENCODINGS)
+
+  def level_for(self, encoding):
+    return self.brotli_level if encoding == 'br' else self.level
+
+  def cached(self, response, entry):
+    """send a cache entry's body compressed, compressing it only the first time
+    for each encoding (entry['encoded'] keeps the results with the entry)"""
+    if response.status_code == 200:
+      encoding = self.negotiate(response.mimetype, len(entry['body']))
+      if encoding:
+        encoded = entry.setdefault('encoded', {})
+        if encoding not in encoded:
+          encoded[encoding] = compress(entry['body'], encoding, self.level_for(encoding))
+        response.set_data(encoded[encoding])
+        self._encoded(response, encoding)
+    return self._vary(response)
+
+  def send_file(self, path, mimetype, **kwargs):
+    """send_file for a stored upload, a compressed variant of it when the client
+    takes one. Variants are written on first use (storage.variant_path) and
+    rewritten when path is newer, so only write-once files (uploads) should
+    come here.
+    """
+    encoding = self.negotiate(mimetype, os.path.getsize(path))
+    if encoding is None:
+      return self._vary(send_file(path, mimetype=mimetype, **kwargs))
+    variant = storage.variant_path(path, encoding)
+    if not os.path.isfile(variant) or os.path.getmtime(variant) < os.path.getmtime(path):
+      with open(path, 'rb') as fp:
+        data = compress(fp.read(), encoding, self.level_for(encoding))
+      storage.write_variant(variant, lambda fp: fp.write(data))
+    response = send_file(variant, mimetype=mimetype, **kwargs)
+    response.headers['Content-Encoding'] = encoding
+    return self._vary(response)
+
+  def _after_request(self, response):
+    if (response.status_code != 200 or response.direct_passthrough
+        or 'Content-Encoding' in response.headers):
+      # files, already compressed (cached(), .gz downloads), 304s and ranges
+      return response
+    if response.is_streamed:
+      encoding = self.negotiate(response.mimetype)
+      if encoding:
+        response.response = compress_chunks(response.iter_encoded(), encoding, self.level_for(encoding))
+        response.headers.pop('Content-Length', None)
+        self._encoded(response, encoding)
+    else:
+      encoding = self.negotiate(response.mimetype, response.calculate_content_length())
+      if encoding:
+        response.set_data(compress(response.get_data(), encoding, self.level_for(encoding)))
+        self._encoded(response, encoding)
+    return self._vary(response)
+
+  def _encoded(self, response, encoding):
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+      # the same resource in other bytes, If-None-Match still matches (weakly)
+      response.set_etag(etag, weak=True)
+
+  def _vary(self, response):
+    if self.enabled and response.mimetype in self.mimetypes:
+      response.vary.add('Accept-Encoding')
+    return response
@@ -0,0 +1,17 @@
+"""gunicorn settings for wsgi:application (see wsgi.py), overridable from the environment
+BLOG_BIND, BLOG_WORKERS, BLOG_THREADS, BLOG_TIMEOUT
+"""
+import os, multiprocessing
+
+bind = os.environ.get('BLOG_BIND', '127.0.0.1:8000')
+# processes run in parallel on multiple cores, each keeps its own caches
+workers = int(os.environ.get('BLOG_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+# requests of a worker run on a bounded thread pool, so one slow request
+# (a large upload, a search) doesn't hold up the rest of that worker
+worker_class = 'gthread'
+threads = int(os.environ.get('BLOG_THREADS', 4))
+timeout = int(os.environ.get('BLOG_TIMEOUT', 30))
+keepalive = 5
+# the app is imported in every worker, none of its connections or
+# background threads are shared across a fork
+preload_app = False
@@ -1,14 +1,30 @@
-import time, datetime, sys, getpass, io, os
-from flask import (Flask, flash, g, session, request, send_from_directory,
-                      redirect, render_template, abort, url_for)
+import time, datetime, sys, getpass, io, os, hashlib, itertools, re, mimetypes, math, random, json, shutil, logging
+import multiprocessing
+from flask import (Flask, flash, g, session, request,
+                      redirect, render_template, abort, url_for, make_response,
+                      Response, safe_join)
 
-from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
+from werkzeug.http import http_date
+from werkzeug.urls import url_quote
 
 from utils import (login_required, admin_required, get_object_or_404, 
-                   strip_tags, query_to_file, slugify, generate_csrf_token)
+                   strip_tags, summarize, query_to_chunks, gzip_chunks, slugify, generate_csrf_token,
+                   validate_csrf_token, new_session_id,
+                   fts_query, highlight, touch_stamp, stamp_version, LRUCache,
+                   paginate_keyset, iter_json_records, hash_password, check_password,
+                   password_needs_rehash, take_token, TokenBuckets, BackgroundJobs,
+                   FragmentCacheExtension, CompressedTextField, CompressedText)
+
+import storage
+from metrics import RequestMetrics
+from compression import ResponseCompressor, FILE_ENCODINGS
+from jinja2 import FileSystemBytecodeCache
 
 from peewee import *
+from playhouse.migrate import SqliteMigrator, migrate
+from playhouse.sqlite_ext import SqliteExtDatabase, FTS5Model, SearchField
+from playhouse.pool import PooledSqliteExtDatabase
 
 ############### BLOG META DEFAULTS #############
 # once running, you can override these defaults
@@ -28,20 +44,163 @@ We look forward to community involvement to add more to the project.
 app = Flask(__name__)
 app.secret_key = '&#*OnNyywiy1$#@'
 app.jinja_env.globals['csrf_token'] = generate_csrf_token 
+app.jinja_env.filters['highlight'] = highlight
+app.jinja_env.add_extension(FragmentCacheExtension)
+app.jinja_env.filters['http_date'] = lambda dt: http_date(time.mktime(dt.timetuple()))
+# csrf tokens are signed, not stored, and a form can be posted this long after rendering
+CSRF_MAX_AGE = 24 * 3600
 HOST = '0.0.0.0'
 PORT = 5000
 DEBUG = False
+# app.logger reports errors and background work (user deletes, image variants)
+# on stderr, INFO and up so finished background jobs show too
+app.logger.setLevel(logging.INFO)
+
+# compiled templates are kept as bytecode in TEMPLATE_CACHE_DIR (BLOG_TEMPLATE_CACHE,
+# unset uses jinja's per-user temp directory, 'off' disables it) so fresh workers
+# load rather than compile them; stale entries are noticed by their source checksum.
+# Template files are only watched for changes in DEBUG, see compile_templates
+TEMPLATE_CACHE_DIR = os.environ.get('BLOG_TEMPLATE_CACHE')
+app.config['TEMPLATES_AUTO_RELOAD'] = DEBUG
+app.jinja_env.auto_reload = DEBUG
+if TEMPLATE_CACHE_DIR != 'off':
+  if TEMPLATE_CACHE_DIR:
+    storage.ensure_dir(TEMPLATE_CACHE_DIR)
+  app.jinja_env.bytecode_cache = FileSystemBytecodeCache(TEMPLATE_CACHE_DIR)
 
 ### FILE UPLOADS PARAMETERS
 # UPLOAD FOLDER will have to change based on your own needs/deployment scenario
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-UPLOAD_FOLDER = os.path.join(BASE_DIR, './uploads')
+UPLOAD_FOLDER = os.environ.get('BLOG_UPLOAD_FOLDER', os.path.join(BASE_DIR, './uploads'))
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 ALLOWED_EXTENSIONS = set(['txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif'])
+# resized copies made of uploaded images in the background (needs Pillow)
+IMAGE_VARIANTS = {'thumb': (200, 200), 'medium': (1024, 1024)}
+image_variants = storage.VariantWorker(IMAGE_VARIANTS, logger=app.logger)
+# how /uploads/<path> is sent
+#   None         - by Flask itself (conditional and Range requests are honoured)
+#   "x-sendfile" - handed to Apache (mod_xsendfile) or lighttpd via X-Sendfile
+#   "x-accel"    - handed to nginx via X-Accel-Redirect to UPLOAD_ACCEL_LOCATION,
+#                  an `internal` location aliased to UPLOAD_FOLDER
+UPLOAD_SENDFILE = None
+UPLOAD_ACCEL_LOCATION = '/_uploads/'
+app.use_x_sendfile = UPLOAD_SENDFILE == 'x-sendfile'
+# uploads under a dated YYYYMM/ folder never change (see storage.py),
+# so browsers and proxies may keep them this long without revalidating
+UPLOAD_MAX_AGE = 365 * 24 * 3600
+DATED_UPLOAD = re.compile(r'^\d{6}/')
 
 # DBPATH will have to change based on your needs/deployment scenario
-DBPATH = os.path.join(BASE_DIR, 'blog.db')
-DB = SqliteDatabase(DBPATH)
+DBPATH = os.environ.get('BLOG_DB_PATH', os.path.join(BASE_DIR, 'blog.db'))
+
+# how database connections are managed (BLOG_DB_MODE environment variable)
+#   "thread"  - each worker thread opens one connection and keeps reusing it
+#   "pool"    - connections are handed back to a pool (playhouse.pool) at teardown
+#   "request" - a new connection per request, closed at teardown
+DB_CONNECTION_MODE = os.environ.get('BLOG_DB_MODE', 'thread')
+DB_POOL_SIZE = 32
+# pragmas run on every new connection. WAL lets readers carry on while a write
+# commits, synchronous=normal is durable under WAL, cache_size is in KiB (-)
+# BLOG_DB_PRAGMAS=off leaves SQLite's defaults (for benchmarking)
+DB_PRAGMAS = [
+  ('journal_mode', 'wal'),
+  ('synchronous', 'normal'),
+  ('cache_size', -16 * 1024),
+  ('mmap_size', 128 * 1024 * 1024),
+  ('temp_store', 'memory'),
+]
+if os.environ.get('BLOG_DB_PRAGMAS') == 'off':
+  DB_PRAGMAS = []
+
+if DB_CONNECTION_MODE == 'pool':
+  # pooled connections move between threads, one thread at a time
+  DB = PooledSqliteExtDatabase(DBPATH, pragmas=DB_PRAGMAS, max_connections=DB_POOL_SIZE,
+                               stale_timeout=600, check_same_thread=False)
+else:
+  DB = SqliteExtDatabase(DBPATH, pragmas=DB_PRAGMAS)
+
+# opt-in request instrumentation (BLOG_METRICS=1), shown at /admin/metrics
+# BLOG_METRICS_PROFILE is the fraction of requests run under cProfile, those
+# slower than METRICS_SLOW_SECONDS keep their profile
+METRICS_ENABLED = os.environ.get('BLOG_METRICS') == '1'
+METRICS_PROFILE_RATE = float(os.environ.get('BLOG_METRICS_PROFILE', 0))
+METRICS_SLOW_SECONDS = 0.5
+request_metrics = None
+if METRICS_ENABLED:
+  request_metrics = RequestMetrics(profile_rate=METRICS_PROFILE_RATE, slow_seconds=METRICS_SLOW_SECONDS)
+  request_metrics.install(app, DB)
+
+# responses of these types are sent gzip (or brotli, if installed) compressed to
+# clients that accept it, unless smaller than COMPRESS_MIN_SIZE bytes. Cached
+# pages/feeds keep their compressed bytes and text uploads get compressed copies
+# next to them, so hits don't compress again. BLOG_COMPRESS=0 turns it off
+# (e.g. when the front-end server compresses)
+COMPRESS_ENABLED = os.environ.get('BLOG_COMPRESS', '1') != '0'
+COMPRESS_MIMETYPES = ['text/html', 'text/plain', 'text/css', 'text/xml', 'application/xml',
+                      'application/rss+xml', 'application/json', 'application/x-ndjson',
+                      'application/javascript']
+COMPRESS_MIN_SIZE = 1024
+response_compressor = ResponseCompressor(COMPRESS_MIMETYPES, COMPRESS_MIN_SIZE, enabled=COMPRESS_ENABLED)
+response_compressor.install(app)
+
+# new password hashes use this werkzeug method, 'pbkdf2:<hash>:<iterations>'.
+# Hashes made with another method or cost are redone when their user logs in
+PASSWORD_METHOD = os.environ.get('BLOG_PASSWORD_METHOD', 'pbkdf2:sha256:150000')
+PASSWORD_SALT_LENGTH = 16
+
+# login attempts are throttled (before any hashing) by token buckets per
+# username and per client address, (burst, attempts regained per second)
+LOGIN_LIMIT_USER = (5, 1 / 60.0)
+LOGIN_LIMIT_ADDR = (20, 1 / 6.0)
+# 'memory' keeps the buckets per process, 'db' shares them between worker processes
+LOGIN_LIMITER = os.environ.get('BLOG_LOGIN_LIMITER', 'memory')
+
+# hard deleting a user who owns more pages and files than this hands the
+# reassignment to a background thread instead of making the admin wait
+USER_DELETE_BACKGROUND_ROWS = 5000
+background_jobs = BackgroundJobs(logger=app.logger)
+
+# BlogMeta is cached per process; saving it rewrites this stamp file so
+# every other worker process notices (by a stat, not a query) and reloads
+BLOGMETA_STAMP = DBPATH + '.meta'
+
+# template fragments in {% cache %} tags (the navbar, the front page's about) are
+# kept per process, they only show the blog meta so its changes clear them
+FRAGMENT_CACHE_SIZE = 100
+
+# rendered page_view.html output is cached per process (LRU, this many entries)
+# any change rewrites PAGECACHE_STAMP so other worker processes drop theirs
+PAGE_CACHE_SIZE = 500
+PAGECACHE_STAMP = DBPATH + '.pages'
+# slug -> page id map kept per process, rewritten when a slug changes
+SLUGMAP_STAMP = DBPATH + '.slugs'
+
+# /feed.xml and /sitemap.xml are kept per process as finished bytes, rebuilt once
+# FEED_STAMP shows that published pages changed. Sitemaps of more than
+# SITEMAP_MAX_URLS pages become an index of /sitemap-<n>.xml parts
+FEED_STAMP = DBPATH + '.feeds'
+FEED_SIZE = 20
+FEED_MAX_AGE = 300
+FEED_CACHE_SIZE = 16
+SITEMAP_MAX_URLS = 50000
+
+# Page.content of CONTENT_COMPRESS_THRESHOLD characters or more are
+# stored zlib compressed when BLOG_COMPRESS_CONTENT=1 (compressed rows are read
+# either way), `python main.py --compress-content` converts the existing rows
+COMPRESS_CONTENT = os.environ.get('BLOG_COMPRESS_CONTENT') == '1'
+CONTENT_COMPRESS_THRESHOLD = 1024
+COMPRESS_BATCH_SIZE = 500
+
+# length of the page snippet shown on listings, stored in Page.summary
+SNIPPET_LENGTH = 100
+
+# number of search results shown per page of /search, and the furthest page
+# ?p= may ask for (larger numbers would overflow OFFSET)
+SEARCH_PAGE_SIZE = 10
+SEARCH_MAX_PAGES = 1000
+# number of cards on each page of the home page, and rows on admin listings
+INDEX_PAGE_SIZE = 5
+LISTING_PAGE_SIZE = 50
 
 ############# OUR MODELS ############
 class BaseModel(Model):
@@ -49,11 +208,27 @@ class BaseModel(Model):
   created_on = DateTimeField(default=datetime.datetime.now)
   class Meta:
     database = DB
+    # every listing is paginated newest first on (created_on, id)
+    indexes = (
+      (('created_on', 'id'), False),
+    )
     
 class BlogMeta(BaseModel):
   """meta information about our blog"""
   brand = CharField(unique=True)
   about = TextField()
+  
+  def save(self, *args, **kwargs):
+    """save, then write-through to this process' cache and signal the others"""
+    rows = super(BlogMeta, self).save(*args, **kwargs)
+    touch_stamp(BLOGMETA_STAMP)
+    _blog_meta_cache['blog'] = self
+    _blog_meta_cache['stamp'] = stamp_version(BLOGMETA_STAMP)
+    # the brand is shown on every page
+    fragment_cache.clear()
+    invalidate_page_cache()
+    invalidate_feeds()
+    return rows
     
 class User(BaseModel):
   """Basic user model"""
@@ -73,20 +248,31 @@ class User(BaseModel):
     return self.username
   
   def authenticate(self, password):
-    """provides basic authentication against a password"""
+    """provides basic authentication against a password
+    a hash made with an older PASSWORD_METHOD is replaced on success
+    """
     # enforce hashing (werkzeug) to make it sort of secure
-    if check_password_hash(self.password, password):
-      return True
-    
-    return False  
+    if not check_password(self.password, password):
+      return False
+    if password_needs_rehash(self.password, PASSWORD_METHOD):
+      self.password = hash_password(password, PASSWORD_METHOD, PASSWORD_SALT_LENGTH)
+      # not save(), nothing cached shows the password
+      User.update(password=self.password).where(User.id==self.id).execute()
+    return True
+  
+  def save(self, *args, **kwargs):
+    """save the user, cached pages may show their display name"""
+    rows = super(User, self).save(*args, **kwargs)
+    invalidate_page_cache()
+    return rows
   
   def password_hash(self):
     # manual hash operation.
-    self.password = generate_password_hash(self.password)  
+    self.password = hash_password(self.password, PASSWORD_METHOD, PASSWORD_SALT_LENGTH)
   
   @classmethod
   def create_user(cls, username, password, email="", displayname="", is_admin=False, is_active=True, avatar_url="", bio=""):
-    hashed_pw = generate_password_hash(password) # enforce password hashing (werkzueg)
+    hashed_pw = hash_password(password, PASSWORD_METHOD, PASSWORD_SALT_LENGTH) # enforce password hashing (werkzueg)
     try:
       with DB.transaction():    
         cls.create(username=username, password=hashed_pw, email=email, displayname=displayname,
@@ -94,6 +280,19 @@ class User(BaseModel):
     except IntegrityError:
       raise ValueError('username already exists')      
     
+  def delete_reassigning(self, new_owner_id):
+    """hard delete the user, their pages and files go to new_owner_id.
+    One UPDATE per table and the DELETE, in a single transaction
+    returns (pages moved, files moved)
+    """
+    with DB.atomic():
+      pages = Page.update(author=new_owner_id).where(Page.author==self.id).execute()
+      files = File.update(owner=new_owner_id).where(File.owner==self.id).execute()
+      User.delete().where(User.id==self.id).execute()
+    # cached pages show their author
+    invalidate_page_cache()
+    return pages, files
+  
   def __repr__(self):
     return self.username
     
@@ -103,7 +302,7 @@ class Page(BaseModel):
   # required fields: author, title, content
   author = ForeignKeyField(User, related_name='author')
   title = CharField()
-  content = TextField()
+  content = CompressedTextField(threshold=CONTENT_COMPRESS_THRESHOLD, enabled=COMPRESS_CONTENT)
   # fields with defaults: slug, is_published, show_title, show_nav, show_sidebar
   slug = TextField(default="") # in case user wants a better url (as a feature page, etc.)
   # boolean type fields for page visibility and presentation options
@@ -112,6 +311,122 @@ class Page(BaseModel):
   show_nav = BooleanField(default=True)
   # not implemented yet
   show_sidebar = BooleanField(default=True)
+  # derived from content on save, so listings never parse HTML
+  summary = TextField(default="")
+  
+  # indexes peewee can't declare in Meta, created with the table / by --migrate
+  # non-empty slugs are unique, routing looks pages up by them
+  partial_indexes = {
+    'page_slug': "CREATE UNIQUE INDEX IF NOT EXISTS page_slug ON page (slug) WHERE slug != ''",
+  }
+  # columns of older versions that --migrate drops (the search index keeps
+  # the plain text searches need, a second uncompressed copy only took space)
+  dropped_columns = ('plain_text',)
+  
+  @classmethod
+  def create_table(cls, fail_silently=False):
+    if fail_silently and cls.table_exists():
+      return  # an existing table gets its indexes from --migrate
+    super(Page, cls).create_table(fail_silently)
+    for sql in cls.partial_indexes.values():
+      DB.execute_sql(sql)
+  
+  @classmethod
+  def dedupe_slugs(cls):
+    """make duplicate slugs unique (older page keeps it, others get -<id>)
+    so the unique slug index can be created, returns pages changed"""
+    count = 0
+    duplicates = (cls.select(cls.slug).where(cls.slug != '')
+                  .group_by(cls.slug).having(fn.COUNT(cls.id) > 1).tuples())
+    for (slug,) in list(duplicates):
+      pages = cls.select(cls.id).where(cls.slug == slug).order_by(cls.id).naive()
+      for page in list(pages)[1:]:
+        cls.update(slug='{}-{}'.format(slug, page.id)).where(cls.id == page.id).execute()
+        count += 1
+    return count
+  
+  def derive_text(self):
+    """(re)compute summary from content, returns the plain text (tags stripped)"""
+    text = strip_tags(self.content)
+    self.summary = summarize(text, SNIPPET_LENGTH)
+    return text
+  
+  @classmethod
+  def backfill_text(cls, batch_size=500):
+    """derive the summary of pages saved before it existed,
+    in batches of batch_size (one transaction each), returns the count"""
+    count, last_id = 0, 0
+    while True:
+      batch = list(cls.select(cls.id, cls.content)
+                   .where((cls.id > last_id) & (cls.summary == ''))
+                   .order_by(cls.id).limit(batch_size).naive())
+      if not batch:
+        return count
+      with DB.atomic():
+        for page in batch:
+          page.derive_text()
+          cls.update(summary=page.summary).where(cls.id==page.id).execute()
+      count += len(batch)
+      last_id = batch[-1].id
+  
+  @classmethod
+  def recompress(cls, batch_size=COMPRESS_BATCH_SIZE):
+    """store content of every page the way its field now would
+    (compressed if enabled and long enough, plain otherwise), in batches of
+    batch_size (one transaction each), returns the number of pages rewritten"""
+    fields = [cls.content]
+    count, last_id = 0, 0
+    while True:
+      batch = list(cls.select(cls.id, *fields).where(cls.id > last_id)
+                   .order_by(cls.id).limit(batch_size).tuples())
+      if not batch:
+        return count
+      with DB.atomic():
+        for row in batch:
+          changes = {}
+          for field, value in zip(fields, row[1:]):
+            text = value.text() if isinstance(value, CompressedText) else value
+            if isinstance(value, CompressedText) != (field.compress(text) is not None):
+              changes[field] = text
+          if changes:
+            cls.update(changes).where(cls.id==row[0]).execute()
+            count += 1
+      last_id = batch[-1][0]
+  
+  def save(self, *args, **kwargs):
+    """save the page and keep its text columns and full-text search entry in step"""
+    text = self.derive_text()
+    # the row as stored before this save: its slug, and whether it was published
+    # (feeds only list published pages, saving a draft leaves them be)
+    stored = None
+    if self.id is not None:
+      stored = Page.select(Page.slug, Page.is_published).where(Page.id==self.id).naive().first()
+    published = self.is_published or (stored is not None and stored.is_published)
+    with DB.atomic():
+      rows = super(Page, self).save(*args, **kwargs)
+      PageIndex.index_page(self, text)
+    invalidate_page_cache(self.id)
+    update_slug_map(stored and stored.slug, self.slug)
+    if published:
+      invalidate_feeds()
+    return rows
+  
+  def delete_instance(self, *args, **kwargs):
+    """delete the page along with its full-text search entry"""
+    with DB.atomic():
+      PageIndex.unindex_page(self)
+      rows = super(Page, self).delete_instance(*args, **kwargs)
+    invalidate_page_cache(self.id)
+    update_slug_map(self.slug, None)
+    if self.is_published:
+      invalidate_feeds()
+    return rows
+  
+  @classmethod
+  def with_authors(cls, *fields):
+    """select pages joined with their author, so listings that show
+    page.author don't run a query per row (N+1)"""
+    return cls.select(*(fields or (cls,)) + (User,)).join(User)
   
   def url(self):
     """return page slug or url for generic page view"""
@@ -119,13 +434,16 @@ class Page(BaseModel):
       return self.slug
     return url_for('page_view',page_id=self.id)
   
-  def snippet(self, length=100):
-    """returns a snippet of a particular length (default=100) without tags"""
-    snippet_length = len(self.content)
-    if snippet_length > length:
-      snippet_length = length
-    plain_text = strip_tags(self.content)
-    return strip_tags(plain_text[0:snippet_length])
+  def external_url(self):
+    """absolute url of the page (feeds, sitemaps)"""
+    return page_external_url(self.id, self.slug)
+  
+  def snippet(self, length=SNIPPET_LENGTH):
+    """returns a snippet of a particular length (default=100) without tags
+    the default length is precomputed at save time (summary)"""
+    if length == SNIPPET_LENGTH and self.summary:
+      return self.summary
+    return summarize(strip_tags(self.content), length)
   
   def date(self, fmt='%B %d, %Y'):
     """returns a nicely formatted date, can override format if you want"""
@@ -136,14 +454,154 @@ class Page(BaseModel):
     return self.title
   
   class Meta:
-    order_by = ('-created_on', 'author')
+    order_by = ('-created_on', '-id')
     
 
+class UserRow(object):
+  """a user as listings show it, only the columns of UserRow.select() and no
+  model instance behind it. Rows come from paginate_keyset(..., row=UserRow.from_tuple)
+  """
+  __slots__ = ('id', 'username', 'displayname', 'is_admin', 'is_active', 'created_on')
+  
+  def __init__(self, id, username, displayname, is_admin=False, is_active=True, created_on=None):
+    self.id, self.username, self.displayname = id, username, displayname
+    self.is_admin, self.is_active, self.created_on = is_admin, is_active, created_on
+  
+  @classmethod
+  def select(cls):
+    return User.select(User.id, User.username, User.displayname, User.is_admin,
+                       User.is_active, User.created_on)
+  
+  @classmethod
+  def from_tuple(cls, values):
+    return cls(*values)
+  
+  def display_name(self):
+    return self.displayname or self.username
+  
+  def __repr__(self):
+    return self.username
+
+
+class PageRow(object):
+  """a page as listings (the front page, admin pages, search) show it: no
+  content, no model instance, its author a UserRow. The listing's snippet is
+  Page.summary, pages saved before it existed need --backfill-text.
+  """
+  __slots__ = ('id', 'created_on', 'title', 'slug', 'summary', 'author', 'excerpt')
+  
+  @classmethod
+  def select(cls, *extra):
+    """the listing query joined with the author, extra columns (search's
+    excerpt) are kept as row.excerpt"""
+    return (Page.select(Page.id, Page.created_on, Page.title, Page.slug, Page.summary,
+                        User.id, User.username, User.displayname, *extra)
+            .join(User))
+  
+  @classmethod
+  def from_tuple(cls, values):
+    row = cls()
+    row.id, row.created_on, row.title, row.slug, row.summary = values[:5]
+    row.author = UserRow(*values[5:8])
+    row.excerpt = values[8] if len(values) > 8 else None
+    return row
+  
+  def url(self):
+    return self.slug or url_for('page_view', page_id=self.id)
+  
+  def date(self, fmt='%B %d, %Y'):
+    return self.created_on.strftime(fmt)
+  
+  def snippet(self):
+    return self.summary
+  
+  def __repr__(self):
+    return self.title
+
+
+class PageIndex(FTS5Model):
+  """FTS5 full-text index of pages, rowid is the Page.id
+  content is indexed as plain text (tags stripped) so markup never matches
+  """
+  title = SearchField()
+  content = SearchField()
+  slug = SearchField()
+  
+  # bm25 column weights (title, content, slug), a title hit counts most
+  WEIGHTS = (10.0, 1.0, 5.0)
+  
+  class Meta:
+    database = DB
+    # stemmed, so "running" finds "run"; an index created without it (before
+    # peewee was given this as extension_options) needs --rebuild-search
+    extension_options = {'tokenize': 'porter unicode61'}
+  
+  @classmethod
+  def index_page(cls, page, text=None):
+    """(re)index a single page, text is its content with the tags stripped
+    when the caller has it already"""
+    if text is None:
+      text = strip_tags(page.content)
+    cls.unindex_page(page)
+    cls.insert(rowid=page.id, title=page.title, content=text, slug=page.slug).execute()
+  
+  @classmethod
+  def unindex_page(cls, page):
+    """remove a single page from the index"""
+    cls.delete().where(cls.rowid==page.id).execute()
+  
+  @classmethod
+  def reindex_all(cls, batch_size=500):
+    """drop and repopulate the whole index from the Page table, returns row count"""
+    DB.drop_tables([cls], safe=True)
+    DB.create_tables([cls], safe=True)
+    count = 0
+    with DB.atomic():
+      rows = []
+      for page in Page.select(Page.id, Page.title, Page.content, Page.slug).naive().iterator():
+        rows.append({'rowid': page.id, 'title': page.title,
+                     'content': strip_tags(page.content), 'slug': page.slug})
+        if len(rows) >= batch_size:
+          cls.insert_many(rows).execute()
+          count += len(rows)
+          rows = []
+      if rows:
+        cls.insert_many(rows).execute()
+        count += len(rows)
+    return count
+  
+  @classmethod
+  def search_pages(cls, term, page_number=1, per_page=SEARCH_PAGE_SIZE):
+    """bm25-ranked PageRows for a user supplied search term.
+    Each row's `excerpt` has the matched words marked,
+    render it with the `highlight` filter. Fetches one extra row so the caller
+    can tell if there is a next page without a COUNT(*).
+    """
+    match = fts_query(term)
+    if not match:
+      return []
+    excerpt = fn.snippet(SQL('"pageindex"'), -1, u'\x02', u'\x03', u'\u2026', 24)
+    offset = (page_number - 1) * per_page
+    query = (PageRow.select(excerpt.alias('excerpt'))
+             .switch(Page)
+             .join(cls, on=(Page.id == cls.rowid))
+             .where(SQL('"pageindex" MATCH ?', match))
+             .order_by(fn.bm25(SQL('"pageindex"'), *cls.WEIGHTS), Page.id)
+             .limit(per_page + 1)
+             .offset(offset))
+    return [PageRow.from_tuple(row) for row in query.tuples()]
+  
+
 class File(BaseModel):
-  """meta information about files that are uploaded by users"""
+  """meta information about files that are uploaded by users
+  filepath is content addressed (see storage.py) so several File rows may
+  share one stored file
+  """
   title = CharField()
-  filepath = CharField(unique=True)
+  filepath = CharField(index=True)
   owner = ForeignKeyField(User, related_name="owner")
+  digest = CharField(default="", index=True) # sha256 of the contents
+  size = IntegerField(default=0)
   
   def __repr__(self):
     return self.title
@@ -151,16 +609,64 @@ class File(BaseModel):
   def url(self):
     return url_for('file_uploads', path=self.filepath)
   
+  def variant_url(self, variant):
+    """url of a resized copy (see IMAGE_VARIANTS), made in the background
+    after upload so it may not exist yet"""
+    return url_for('file_uploads', path=storage.variant_path(self.filepath, variant))
+  
+  @classmethod
+  def with_owners(cls):
+    """select files joined with their owner (one query for listings)"""
+    return cls.select(cls, User).join(User)
+  
   class Meta:
-    order_by = ('-created_on','title')
+    order_by = ('-created_on', '-id')
+  
+
+class RateBucket(BaseModel):
+  """token buckets shared by all worker processes (LOGIN_LIMITER = 'db')"""
+  key = CharField(unique=True)
+  tokens = FloatField()
+  updated = FloatField()
+  
+  @classmethod
+  def take(cls, key, capacity, per_second, now=None):
+    """like utils.TokenBuckets.take, returns 0 or the seconds to wait for a token"""
+    now = time.time() if now is None else now
+    with DB.atomic():
+      bucket = cls.select().where(cls.key==key).first()
+      if bucket is None:
+        tokens, updated = capacity, now
+      else:
+        tokens, updated = bucket.tokens, bucket.updated
+      tokens, wait = take_token(tokens, updated, now, capacity, per_second)
+      cls.insert(key=key, tokens=tokens, updated=now).upsert().execute()
+      if random.random() < 0.01:
+        # buckets untouched this long are full again, same as no row
+        cls.delete().where(cls.updated < now - capacity / per_second).execute()
+    return wait
   
 ################### END MODELS #########################
   
 def initialize(args=[]):
   """initialize the database and CLI (command line args)
   --drop <table> (valid table aliases are "users", "pages", or "files")
+  --fix-ownership (give pages/files of deleted users to the first admin)
+  --compile-templates (fill the template bytecode cache, e.g. as a deploy step)
+  --make-variants (make missing image thumbnails, e.g. for uploads stored before
+    variants moved to their own directory)
+  --export-static out=<dir> [base=<site url>] [processes=<n>] [--full] (render the
+    published site into a directory for a static server, only what changed since
+    the last export into that directory unless --full)
   --createadmin (creation of an administrator account for initial login)
   --init (safe creation of tables in case we're starting out.)
+  --rebuild-search (repopulate the full-text search index from all pages)
+  --migrate (add missing tables, columns and indexes to an existing database)
+  --backfill-text (derive snippets of pages saved before --migrate added them)
+  --compress-content [--vacuum] (rewrite page text compressed or plain as BLOG_COMPRESS_CONTENT
+    says, --vacuum then gives the space freed back to the filesystem)
+  --import users=<file> pages=<file> files=<file> (load exports made by export_model,
+    any subset; users are loaded first so page authors/file owners get remapped)
   Some deployment methodologies will make initialize unreachable except from CLI
   """
   
@@ -170,10 +676,81 @@ def initialize(args=[]):
   
   if '--init' in args or '--initialize' in args:
     # SAFE CREATION OF TABLES, And exit
-    DB.create_tables([BlogMeta, User, Page, File], safe=True)
+    DB.create_tables([BlogMeta, User, Page, PageIndex, File, RateBucket], safe=True)
     print("tables created (safe), exiting.")
     sys.exit(0)
   
+  if '--migrate' in args:
+    # bring a database created by an older version up to date
+    migrate_schema()
+    print("database migrated, exiting.")
+    sys.exit(0)
+  
+  if '--export-static' in args:
+    options = dict(arg.split('=', 1) for arg in args if '=' in arg)
+    if 'out' not in options:
+      print("--export-static needs out=<directory>")
+      sys.exit(1)
+    processes = int(options['processes']) if 'processes' in options else None
+    rendered, unchanged, removed, elapsed = export_static(options['out'], options.get('base'),
+                                                          processes, '--full' in args)
+    print("{} pages rendered, {} unchanged, {} removed in {:.1f}s, exiting.".format(
+      rendered, unchanged, removed, elapsed))
+    sys.exit(0)
+  
+  if '--compile-templates' in args:
+    count = compile_templates()
+    print("{} templates compiled into {}, exiting.".format(
+      count, TEMPLATE_CACHE_DIR or 'the default bytecode cache'))
+    sys.exit(0)
+  
+  if '--make-variants' in args:
+    images, removed = remake_image_variants()
+    print("variants of {} images made, {} in the old layout removed, exiting.".format(images, removed))
+    sys.exit(0)
+  
+  if '--fix-ownership' in args:
+    admin = User.select().where(User.is_admin==True).order_by(User.id).first()
+    if admin is None:
+      print("no admin to give them to, create one with --createadmin")
+      sys.exit(1)
+    pages, files = fix_ownership(admin.id)
+    print("{} pages and {} files given to {}, exiting.".format(pages, files, admin.username))
+    sys.exit(0)
+  
+  if '--import' in args:
+    # bulk load exported users/pages/files, in that order
+    sources = dict(arg.split('=', 1) for arg in args if '=' in arg)
+    user_map = {}
+    for alias in ('users', 'pages', 'files'):
+      if alias in sources:
+        with open(sources[alias], 'rb') as fp:
+          count, elapsed = bulk_import(IMPORT_MODELS[alias], iter_json_records(fp), user_map)
+        print("{} {} imported in {:.1f}s ({:.0f} rows/sec)".format(
+          count, alias, elapsed, count / max(elapsed, 1e-6)))
+    sys.exit(0)
+  
+  if '--backfill-text' in args:
+    count = Page.backfill_text()
+    print("snippets derived for {} pages, exiting.".format(count))
+    sys.exit(0)
+  
+  if '--compress-content' in args:
+    before = os.path.getsize(DBPATH)
+    count = Page.recompress()
+    if '--vacuum' in args:
+      DB.execute_sql('VACUUM')
+    print("{} pages {}, database {:.1f} -> {:.1f} MB, exiting.".format(
+      count, 'compressed' if COMPRESS_CONTENT else 'decompressed',
+      before / 1048576.0, os.path.getsize(DBPATH) / 1048576.0))
+    sys.exit(0)
+  
+  if '--rebuild-search' in args:
+    # repopulate the full-text search index from the pages table
+    count = PageIndex.reindex_all()
+    print("search index rebuilt ({} pages), exiting.".format(count))
+    sys.exit(0)
+  
   if '--drop' in args:
     if 'users' in args:
       resp = raw_input("DELETE all USERS? (type DELETE) to confirm: ")
@@ -187,7 +764,7 @@ def initialize(args=[]):
     if 'pages' in args:
       resp = raw_input("DELETE all PAGES? (type DELETE) to confirm: ")
       if resp == "DELETE":
-        DB.drop_tables([Page])
+        DB.drop_tables([PageIndex, Page])
         print("PAGES dropped, exiting.")
       else:
         print("Cancelled")
@@ -216,40 +793,516 @@ def initialize(args=[]):
 
 
 
-def get_blog_meta():
-  """grabs the blog meta data for branding, etc."""
-  blog = BlogMeta.select()
-  if len(blog):
-    blog = blog[0]
+def migrate_schema():
+  """bring an existing database up to date with the models, safe to re-run.
+  create_tables(safe=True) skips tables that exist, so columns and indexes
+  added since they were created are added here, and a model's dropped_columns
+  dropped (`--compress-content --vacuum` then gives their space back).
+  """
+  DB.create_tables([BlogMeta, User, Page, PageIndex, File, RateBucket], safe=True)
+  migrator = SqliteMigrator(DB)
+  compiler = DB.compiler()
+  for model in (BlogMeta, User, Page, File):
+    table = model._meta.db_table
+    columns = set(column.name for column in DB.get_columns(table))
+    changed = [migrator.add_column(table, field.db_column, field)
+             for field in model._meta.sorted_fields if field.db_column not in columns]
+    changed += [migrator.drop_column(table, name)
+              for name in getattr(model, 'dropped_columns', ()) if name in columns]
+    wanted = {}
+    for fields, unique in model._index_data():
+      names = [model._meta.fields[f].db_column if isinstance(f, basestring) else f.db_column
+               for f in fields]
+      wanted[compiler.index_name(table, names)] = (names, unique)
+    partial = getattr(model, 'partial_indexes', {})
+    with DB.atomic():
+      migrate(*changed)
+      # read after the columns changed, add_column indexes index=True/unique ones itself
+      indexes = dict((index.name, index.unique) for index in DB.get_indexes(table))
+      operations = []
+      for name, unique in list(indexes.items()):
+        # drop indexes the model no longer declares (or declares differently)
+        if name.startswith('sqlite_') or name in partial:
+          continue
+        if name not in wanted or wanted[name][1] != unique:
+          operations.append(migrator.drop_index(table, name))
+          del indexes[name]
+      for name, (names, unique) in wanted.items():
+        if name not in indexes:
+          operations.append(migrator.add_index(table, names, unique))
+      migrate(*operations)
+      if model is Page and Page.dedupe_slugs():
+        reload_slug_map()
+      for sql in partial.values():
+        DB.execute_sql(sql)
+
+IMPORT_MODELS = {'users': User, 'pages': Page, 'files': File}
+# exported pages/files carry their user's username as <field>_username, imports
+# find the author/owner by it (user ids differ from one blog to the next)
+OWNER_FIELDS = {Page: Page.author, File: File.owner}
+
+def bulk_import(model, records, user_map=None, default_owner=None, transaction_size=5000):
+  """load exported records (dicts, see export_model) into model with batched
+  insert_many, committing every transaction_size rows.
+  Exported ids are not kept. Page.author/File.owner are found by the username
+  exported with the row (author_username/owner_username); for exports without
+  one, user_map ({exported user id: id here}, filled in when importing users,
+  existing usernames map to the existing user) is used. Rows whose user isn't
+  found either way go to default_owner (the first admin by default), an
+  exported id is never taken to mean the user that has it here.
+  Rows that clash with a unique column (username, filepath) are skipped.
+  returns (rows read, seconds taken)
+  """
+  started = time.time()
+  user_map = {} if user_map is None else user_map
+  fields = [f for f in model._meta.sorted_fields if not f.primary_key]
+  # keep each INSERT under SQLite's (older) 999 bound-parameter limit
+  batch_size = max(1, 999 // len(fields))
+  owner_field = OWNER_FIELDS.get(model)
+  if model is Page:
+    # slugs are unique, clashing ones get a numeric suffix
+    taken_slugs = set(slug_map())
+  if owner_field is not None:
+    owner_name = owner_field.name + '_username'
+    if default_owner is None:
+      admin = User.select(User.id).where(User.is_admin == True).order_by(User.id).first()
+      default_owner = admin.id if admin else None
+  
+  def prepare(record, owners):
+    row = dict((f.name, record[f.name]) for f in fields if f.name in record)
+    if model is Page:
+      page = Page(content=row.get('content', ''))
+      page.derive_text()
+      row['summary'] = page.summary
+      slug, n = row.get('slug') or '', 1
+      while slug in taken_slugs:
+        n += 1
+        slug = '{}-{}'.format(row['slug'], n)
+      if slug:
+        taken_slugs.add(slug)
+      row['slug'] = slug
+    if owner_field is not None:
+      if record.get(owner_name) is not None:
+        owner = owners.get(record[owner_name])
+      else:
+        owner = user_map.get(row.get(owner_field.name))
+      row[owner_field.name] = default_owner if owner is None else owner
+    return row
+  
+  def insert(records):
+    owners = {}
+    if owner_field is not None:
+      names = set(record[owner_name] for record in records if record.get(owner_name) is not None)
+      if names:
+        owners = dict(User.select(User.username, User.id).where(User.username << list(names)).tuples())
+    rows = [prepare(record, owners) for record in records]
+    model.insert_many(rows).on_conflict('IGNORE').execute()
+    if model is User:
+      names = [row['username'] for row in rows]
+      found = dict((u.username, u.id) for u in
+                   User.select(User.id, User.username).where(User.username << names).naive())
+      for record in records:
+        user_map[record.get('id')] = found[record['username']]
+  
+  count = 0
+  records = iter(records)
+  while True:
+    chunk = list(itertools.islice(records, transaction_size))
+    if not chunk:
+      break
+    with DB.atomic():
+      for i in range(0, len(chunk), batch_size):
+        insert(chunk[i:i + batch_size])
+    count += len(chunk)
+  
+  if model is Page:
+    # insert_many bypasses Page.save(), so reindex for search in one go
+    PageIndex.reindex_all()
+    reload_slug_map()
+    invalidate_feeds()
+  invalidate_page_cache()
+  return count, time.time() - started
+
+# pages rendered per task by the --export-static process pool
+EXPORT_BATCH_SIZE = 100
+EXPORT_MANIFEST = '.export-manifest.json'
+
+def fs_path(path):
+  """unicode paths (slugs, the export manifest) as utf-8 bytes on python 2"""
+  return path if isinstance(path, str) else path.encode('utf-8')
+
+def export_path(out_dir, url_path):
+  """file a static server finds url_path at, <path>/index.html for pages
+  (None if the path would escape out_dir)"""
+  relative = fs_path(url_path.strip('/'))
+  if not relative.endswith('.xml'):
+    relative = os.path.join(relative, 'index.html')
+  return safe_join(out_dir, relative)
+
+def export_write(out_dir, url_path, body):
+  """write a rendered url below out_dir, returns its path relative to out_dir (text)"""
+  path = export_path(out_dir, url_path)
+  if path is None:
+    return None
+  storage.ensure_dir(os.path.dirname(path))
+  # a static server reading along never sees half a file
+  temp = path + '.tmp'
+  with open(temp, 'wb') as fp:
+    fp.write(body)
+  os.rename(temp, path)
+  relative = os.path.relpath(path, out_dir)
+  return relative if not isinstance(relative, bytes) else relative.decode('utf-8')
+
+def export_render(job):
+  """render a batch of pages at /page/<id> and their slug (a process pool task)
+  returns [(page id, [written paths])]
+  """
+  out_dir, base_url, pages = job
+  client = app.test_client()
+  done = []
+  for page_id, slug in pages:
+    paths = []
+    for url_path in ['/page/{}'.format(page_id)] + (['/' + slug] if slug else []):
+      response = client.get(url_quote(url_path, safe='/:'), base_url=base_url)
+      if response.status_code == 200:
+        # saved unquoted, static servers decode the url to find the file
+        paths.append(export_write(out_dir, url_path, response.get_data()))
+    done.append((page_id, [path for path in paths if path]))
+  return done
+
+def export_site_digest(base_url):
+  """changes whenever every page has to be rendered again: templates, blog meta, host"""
+  digest = hashlib.sha1((base_url or '').encode('utf-8'))
+  for name in sorted(app.jinja_env.list_templates()):
+    digest.update(app.jinja_loader.get_source(app.jinja_env, name)[0].encode('utf-8'))
+  blog = get_blog_meta()
+  digest.update(u'{}\0{}'.format(blog.brand, blog.about).encode('utf-8'))
+  return digest.hexdigest()
+
+def export_uploads(out_dir):
+  """mirror UPLOAD_FOLDER into out_dir/uploads, hardlinking where possible
+  (uploads never change in place); returns how many files were added"""
+  source = app.config['UPLOAD_FOLDER']
+  added = 0
+  for directory, dirnames, filenames in os.walk(source):
+    target_dir = os.path.join(out_dir, 'uploads', os.path.relpath(directory, source))
+    for filename in filenames:
+      if filename.startswith('.'):
+        continue  # uploads and variants still being written
+      if (os.path.basename(directory) == storage.VARIANT_DIR
+          and filename.split('.', 1)[0] in FILE_ENCODINGS):
+        continue  # compressed copies, the static server compresses on its own
+      target = os.path.join(target_dir, filename)
+      if os.path.exists(target):
+        continue
+      storage.ensure_dir(target_dir)
+      try:
+        os.link(os.path.join(directory, filename), target)
+      except OSError:
+        shutil.copy2(os.path.join(directory, filename), target)
+      added += 1
+  return added
+
+def export_static(out_dir, base_url=None, processes=None, full=False):
+  """render the published site into out_dir for a static server or CDN:
+  /index (also as the root), every published page at /page/<id> and at its
+  slug, the feed, the sitemap(s), and a copy of the uploads.
+  
+  Pages are rendered by a pool of processes. A manifest in out_dir remembers
+  a digest of what every page was rendered from, so later runs only render
+  pages that changed (all of them after a template or blog meta change, or
+  with full) and remove those no longer published.
+  returns (pages rendered, pages unchanged, pages removed, seconds)
+  """
+  started = time.time()
+  base_url = base_url or 'http://localhost/'
+  storage.ensure_dir(out_dir)
+  manifest_path = os.path.join(out_dir, EXPORT_MANIFEST)
+  try:
+    with open(manifest_path) as fp:
+      manifest = json.load(fp)
+  except (IOError, ValueError):
+    manifest = {}
+  site = export_site_digest(base_url)
+  previous = manifest.get('pages', {})
+  rerender_all = full or manifest.get('site') != site
+  
+  current, todo = {}, []
+  rows = (Page.select(Page.id, Page.slug, Page.title, Page.content, Page.show_title, Page.show_nav,
+                      Page.show_sidebar, Page.created_on, User.username, User.displayname)
+          .join(User).where(Page.is_published==True).order_by(Page.id).tuples())
+  for row in rows.iterator():
+    key = str(row[0])
+    current[key] = {'digest': hashlib.sha1(repr(row).encode('utf-8')).hexdigest(), 'paths': []}
+    if rerender_all or previous.get(key, {}).get('digest') != current[key]['digest']:
+      todo.append((row[0], row[1]))
+    else:
+      current[key]['paths'] = previous[key]['paths']
+  
+  jobs = [(out_dir, base_url, todo[i:i + EXPORT_BATCH_SIZE]) for i in range(0, len(todo), EXPORT_BATCH_SIZE)]
+  if processes == 1 or len(jobs) < 2:
+    results = [export_render(job) for job in jobs]
   else:
-    blog = BlogMeta.create(brand=default_brand, about=default_about)
+    # workers are forked, they must not inherit an open sqlite connection
+    DB.close()
+    pool = multiprocessing.Pool(processes)
+    try:
+      results = pool.map(export_render, jobs)
+    finally:
+      pool.close()
+      pool.join()
+  for page_id, paths in itertools.chain.from_iterable(results):
+    current[str(page_id)]['paths'] = paths
+  
+  # files of unpublished/deleted pages and old slugs
+  kept = set(path for entry in current.values() for path in entry['paths'])
+  stale = set(path for entry in previous.values() for path in entry['paths']) - kept
+  for path in stale:
+    try:
+      os.remove(os.path.join(out_dir, fs_path(path)))
+      os.removedirs(os.path.dirname(os.path.join(out_dir, fs_path(path))))
+    except OSError:
+      pass  # already gone, or the directory holds other files
+  removed = len(set(previous) - set(current))
+  
+  client = app.test_client()
+  site_paths = ['/index', '/feed.xml', '/sitemap.xml']
+  parts = int(math.ceil(len(current) / float(SITEMAP_MAX_URLS)))
+  if parts > 1:
+    site_paths += ['/sitemap-{}.xml'.format(n) for n in range(1, parts + 1)]
+  for url_path in site_paths:
+    body = client.get(url_path, base_url=base_url).get_data()
+    export_write(out_dir, url_path, body)
+    if url_path == '/index':
+      export_write(out_dir, '/', body)
+  export_uploads(out_dir)
+  
+  temp = manifest_path + '.tmp'
+  with open(temp, 'w') as fp:
+    json.dump({'site': site, 'pages': current}, fp)
+  os.rename(temp, manifest_path)
+  return len(todo), len(current) - len(todo), removed, time.time() - started
+
+_blog_meta_cache = {}
+
+def get_blog_meta():
+  """grabs the blog meta data for branding, etc.
+  Served from the per-process cache, it is only (re)loaded from the database
+  when the BLOGMETA_STAMP file shows another process saved a change.
+  """
+  stamp = stamp_version(BLOGMETA_STAMP)
+  blog = _blog_meta_cache.get('blog')
+  if blog is None or _blog_meta_cache.get('stamp') != stamp:
+    blog = BlogMeta.select().first()
+    if blog is None:
+      blog = BlogMeta.create(brand=default_brand, about=default_about)
+    else:
+      _blog_meta_cache['blog'] = blog
+      _blog_meta_cache['stamp'] = stamp
+      # changed by another process, fragments may show the old one
+      fragment_cache.clear()
   return blog
 
+fragment_cache = LRUCache(FRAGMENT_CACHE_SIZE)
+app.jinja_env.fragment_cache = fragment_cache
+# fragments show g.brand, read in before_request
+app.jinja_env.fragment_cache_generation = lambda: g.get('fragment_cache_generation')
+
+page_cache = LRUCache(PAGE_CACHE_SIZE)
+_page_cache_stamp = {}
+
+def invalidate_page_cache(page_id=None):
+  """drop cached renderings of one page (or all pages when page_id is None)
+  and tell the other worker processes to drop theirs
+  """
+  if page_id is None:
+    page_cache.clear()
+  else:
+    page_cache.delete_where(lambda entry: entry['page_id'] == page_id)
+  touch_stamp(PAGECACHE_STAMP)
+  _page_cache_stamp['stamp'] = stamp_version(PAGECACHE_STAMP)
+
+def page_cache_key(route_key):
+  """cache key, a route key plus the variant of the visitor viewing it.
+  Anonymous visitors all share one rendering, logged in users see their own
+  navbar/edit links so they are keyed per user.
+  """
+  if session.get('is_authenticated'):
+    return (route_key, session.get('user_id'), bool(session.get('is_admin')))
+  return (route_key, None, False)
+
+def page_cache_get(route_key):
+  """return a cached rendering for this route and visitor, or None"""
+  stamp = stamp_version(PAGECACHE_STAMP)
+  if _page_cache_stamp.get('stamp') != stamp:
+    # another process changed something
+    page_cache.clear()
+    _page_cache_stamp['stamp'] = stamp
+  if '_flashes' in session:
+    # pending flash messages are rendered into the layout
+    return None
+  return page_cache.get(page_cache_key(route_key))
+
+def page_cache_render(route_key, page):
+  """render page_view.html for page, caching the result when possible (not
+  when the cache was invalidated since this request started, page may be stale)"""
+  cacheable = '_flashes' not in session
+  body = render_template('page_view.html', page=page).encode('utf-8')
+  entry = {'body': body, 'page_id': page.id,
+           'etag': hashlib.md5(body).hexdigest(),
+           'last_modified': datetime.datetime.utcnow().replace(microsecond=0)}
+  if cacheable:
+    page_cache.set(page_cache_key(route_key), entry, g.page_cache_generation)
+  return entry
+
+def page_cache_response(entry):
+  """build a conditional (ETag/Last-Modified, 304) response from a cache entry"""
+  response = make_response(entry['body'])
+  response.set_etag(entry['etag'])
+  response.last_modified = entry['last_modified']
+  response.headers['Vary'] = 'Cookie'
+  response.cache_control.no_cache = True
+  if session.get('is_authenticated'):
+    response.cache_control.private = True
+  return response_compressor.cached(response.make_conditional(request), entry)
+
+feed_cache = LRUCache(FEED_CACHE_SIZE)
+_feed_cache_stamp = {}
+
+def invalidate_feeds():
+  """published pages changed, feeds and sitemaps are rebuilt (in every process)"""
+  feed_cache.clear()
+  touch_stamp(FEED_STAMP)
+  _feed_cache_stamp['stamp'] = stamp_version(FEED_STAMP)
+
+def page_external_url(page_id, slug):
+  if slug:
+    return url_for('site', path=slug, _external=True)
+  return url_for('page_view', page_id=page_id, _external=True)
+
+def page_external_url_builder():
+  """page_external_url for many pages (sitemaps), url_for runs once per route
+  and slugs are quoted the way the site route's path converter does
+  """
+  site_prefix = url_for('site', path='_', _external=True)[:-1]
+  view_prefix = url_for('page_view', page_id=0, _external=True)[:-1]
+  def build(page_id, slug):
+    if slug:
+      return site_prefix + url_quote(slug, safe='/:')
+    return view_prefix + str(page_id)
+  return build
+
+def feed_response(name, build, mimetype='application/xml'):
+  """conditional response (ETag, 304) for a feed or sitemap document.
+  build() returns its bytes (None for 404) and is called once per change of
+  the published pages, per host (the document holds absolute urls). One built
+  after the feeds were invalidated mid-request is sent but not kept.
+  """
+  stamp = stamp_version(FEED_STAMP)
+  if _feed_cache_stamp.get('stamp') != stamp:
+    # another process changed something
+    feed_cache.clear()
+    _feed_cache_stamp['stamp'] = stamp
+  key = (name, request.url_root)
+  entry = feed_cache.get(key)
+  if entry is None:
+    body = build()
+    if body is None:
+      abort(404)
+    entry = {'body': body, 'etag': hashlib.md5(body).hexdigest()}
+    feed_cache.set(key, entry, g.feed_cache_generation)
+  response = make_response(entry['body'])
+  response.mimetype = mimetype
+  response.set_etag(entry['etag'])
+  response.cache_control.public = True
+  response.cache_control.max_age = FEED_MAX_AGE
+  return response_compressor.cached(response.make_conditional(request), entry)
+
+_slug_map = {}
+
+def slug_map():
+  """{slug: page id} of every page with a slug, loaded once per process and
+  reloaded only when another process changed a slug (SLUGMAP_STAMP)"""
+  stamp = stamp_version(SLUGMAP_STAMP)
+  if 'slugs' not in _slug_map or _slug_map['stamp'] != stamp:
+    slugs = dict(Page.select(Page.slug, Page.id).where(Page.slug != '').tuples())
+    _slug_map.update(slugs=slugs, stamp=stamp)
+  return _slug_map['slugs']
+
+def update_slug_map(old_slug, slug):
+  """a page's slug went from old_slug (as stored before the change) to slug,
+  None when the page is new or gone. Compared with what was stored rather than
+  with the map, which may already have been reloaded with the change in it, so
+  every process (this one too) reloads whenever a slug really changed
+  """
+  if (old_slug or None) == (slug or None):
+    return  # unchanged, nothing to tell the other processes
+  reload_slug_map()
+
+def reload_slug_map():
+  """after bulk changes, reload here and in the other processes"""
+  _slug_map.clear()
+  touch_stamp(SLUGMAP_STAMP)
+
+def compile_templates():
+  """load every template (compiled, or from the bytecode cache) into this
+  process' template cache, returns how many. wsgi.py runs it as workers start
+  """
+  names = app.jinja_env.list_templates()
+  for name in names:
+    app.jinja_env.get_template(name)
+  return len(names)
+
+@app.before_first_request
+def warm_caches():
+  """load per-process lookups before the first request needs them"""
+  slug_map()
+
 @app.before_request
 def before_request():
   """tasks before request is executed"""
+  if request.endpoint == 'file_uploads':
+    # static files need neither the database nor the blog meta
+    return
   g.db = DB
-  g.db.connect()
-  blog = get_blog_meta()
-  g.brand = blog.brand  
+  if DB.is_closed():
+    DB.connect()
+  # taken before anything a cached rendering shows is read (the blog meta here,
+  # the page later), a change saved meanwhile keeps this request's out of the cache
+  g.page_cache_generation = page_cache.generation
+  g.feed_cache_generation = feed_cache.generation
+  g.fragment_cache_generation = fragment_cache.generation
+  g.blog = get_blog_meta()
+  g.brand = g.blog.brand
   g.user_id = session.get('user_id')
   g.username = session.get('username')
   
-  # recommended csrf protection
+  # recommended csrf protection, checked without touching the session
   if request.method == "POST":
-    if session.get('no_csrf'):
-      # handle temporary csrf override
-      session.pop('no_csrf')
+    if not validate_csrf_token(request.form.get('_csrf_token'), CSRF_MAX_AGE):
+      abort(400)
+  
+@app.teardown_request
+def teardown_request(exception):
+  """tasks after request is executed, runs even if the view raised"""
+  if DB_CONNECTION_MODE != 'thread' and not DB.is_closed():
+    # pool mode hands the connection back to the pool
+    DB.close()
+
+_login_buckets = {'user': TokenBuckets(*LOGIN_LIMIT_USER), 'addr': TokenBuckets(*LOGIN_LIMIT_ADDR)}
+
+def login_wait(username, address):
+  """take a login attempt from the username's and the address' buckets
+  returns 0 if the attempt may go ahead, else the seconds to wait
+  """
+  waits = []
+  for kind, limit, key in (('user', LOGIN_LIMIT_USER, (username or '').lower()),
+                           ('addr', LOGIN_LIMIT_ADDR, address or '')):
+    if LOGIN_LIMITER == 'db':
+      waits.append(RateBucket.take(u'{}:{}'.format(kind, key), *limit))
     else:
-      token = session.pop('_csrf_token', None)
-      if not token or token != request.form.get('_csrf_token'):
-          abort(400)  
-  
-@app.after_request
-def after_request(response):
-  """tasks after request is executed"""
-  g.db.close()
-  return response
+      waits.append(_login_buckets[kind].take(key))
+  return max(waits)
 
 @app.route('/login', methods=('GET','POST'))
 def login():
@@ -258,9 +1311,18 @@ def login():
   if request.method == 'POST':
     username = request.form.get('username')
     password = request.form.get('password')
+    wait = login_wait(username, request.remote_addr)
+    if wait:
+      wait = int(math.ceil(wait))
+      flash("Too many login attempts, try again in {} seconds.".format(wait), category="danger")
+      response = make_response(render_template('login.html'), 429)
+      response.headers['Retry-After'] = str(wait)
+      return response
     try:
       user = User.get(User.username==username)
       if user.authenticate(password) and user.is_active:
+        # a fresh session id, tokens from the login form don't carry over
+        session['sid'] = new_session_id()
         session['is_admin'] = user.is_admin
         session['is_authenticated'] = True
         session['username'] = username
@@ -286,9 +1348,23 @@ def allowed_file(filename):
 
 @app.route('/uploads/<path:path>')
 def file_uploads(path):
-  """serve up a file in our uploads"""
-  print("access path={}".format(path))
-  return send_from_directory(app.config['UPLOAD_FOLDER'], path)
+  """serve up a file in our uploads (optionally through the front-end server, see UPLOAD_SENDFILE)"""
+  if UPLOAD_SENDFILE == 'x-accel':
+    filename = safe_join(app.config['UPLOAD_FOLDER'], path)
+    if filename is None or not os.path.isfile(filename):
+      abort(404)
+    response = make_response('')
+    response.mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    response.headers['X-Accel-Redirect'] = UPLOAD_ACCEL_LOCATION + path
+  else:
+    filename = safe_join(app.config['UPLOAD_FOLDER'], path)
+    if filename is None or not os.path.isfile(filename):
+      abort(404)
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    response = response_compressor.send_file(filename, mimetype, conditional=True)
+  if DATED_UPLOAD.match(path):
+    response.headers['Cache-Control'] = 'public, max-age={}, immutable'.format(UPLOAD_MAX_AGE)
+  return response
 
 @app.route('/upload', methods=['GET', 'POST'])
 @login_required
@@ -307,51 +1383,37 @@ def file_upload():
       return redirect(request.url)
     if file and allowed_file(file.filename):
       filename = secure_filename(file.filename)
-      subfolder = datetime.datetime.strftime(datetime.datetime.now(), "%Y%m/")
-      pathname = os.path.join(app.config['UPLOAD_FOLDER'], subfolder, filename)
-      
-      # handle name collision if needed
-      # filename will add integers at beginning of filename in dotted fashion
-      # hello.jpg => 1.hello.jpg => 2.hello.jpg => ...
-      # until it finds an unused name
-      i=1
-      while os.path.isfile(pathname):
-        parts = filename.split('.')
-        parts.insert(0,str(i))
-        filename = '.'.join(parts)
-        i += 1
-        if i > 100:
-          # probably under attack, so just fail
-          raise ValueError("too many filename collisions, administrator should check this out")
-        
-        pathname = os.path.join(app.config['UPLOAD_FOLDER'], subfolder, filename)
-        
+      subfolder = datetime.datetime.strftime(datetime.datetime.now(), "%Y%m")
+      upload_folder = app.config['UPLOAD_FOLDER']
       try:
-        # ensure directory where we are storing exists, and create it
-        directory = os.path.join(app.config['UPLOAD_FOLDER'], subfolder)
-        if not os.path.exists(directory):
-          os.makedirs(directory)
-        # finally, save the file AND create its resource object in database
-        file.save(pathname)
-        local_filepath = os.path.join(subfolder, filename)
-        file_object = File.create(title=filename, filepath=local_filepath, owner=session['user_id'])
+        # stream to disk while hashing, the stored path comes from the digest
+        # so there are no name collisions to probe for
+        temp_path, digest, size = storage.receive(file.stream, upload_folder)
+        local_filepath = storage.content_path(subfolder, digest, filename)
+        # identical bytes already stored under another name get hardlinked
+        same = File.select(File.filepath).where(File.digest==digest).first()
+        storage.place(temp_path, os.path.join(upload_folder, local_filepath),
+                      same and os.path.join(upload_folder, same.filepath))
+        file_object = File.create(title=filename, filepath=local_filepath, owner=session['user_id'],
+                                  digest=digest, size=size)
+        image_variants.submit(os.path.join(upload_folder, local_filepath))
         return redirect(url_for('file_edit', file_id=file_object.id))
-      except Exception as e:
-        print(e)
+      except Exception:
+        app.logger.exception("file upload failed")
         flash("Something went wrong here-- please let administrator know", category="danger")
         raise ValueError("Something went wrong with file upload.")
       
   # TODO, replace with fancier upload drag+drop
-  session['no_csrf'] = True
   return '''
     <!doctype html>
     <title>Upload new File</title>
     <h1>Upload new File</h1>
     <form method=post enctype=multipart/form-data>
+      <input type=hidden name=_csrf_token value="{}">
       <p><input type=file name=file>
          <input type=submit value=Upload>
     </form>
-    '''
+    '''.format(generate_csrf_token())
 
 
 @app.route('/logout')
@@ -370,19 +1432,61 @@ def index():
   s = request.args.get('s')
   if s:
     return redirect( url_for('search', s=s) )  
-  if len(User.select()) == 0:
+  if not User.select().exists():
     return redirect(url_for('admin_first_use'))  
-  pages = Page.select()
-  blog = BlogMeta.select()[0]
-  if len(pages) > 5:
-    # limit the front page to 5 pages.
-    pages = pages[0:5]
-  return render_template('index.html', pages=pages, blog=blog)
-
-def fix_page_ownership():
-  pages = Page.select()
-  for page in pages:
-    print page.author
+  # the front page shows INDEX_PAGE_SIZE pages, older ones via ?after=<cursor>
+  pages, next_cursor = paginate_keyset(PageRow.select(), Page, request.args.get('after'),
+                                       INDEX_PAGE_SIZE, row=PageRow.from_tuple)
+  return render_template('index.html', pages=pages, blog=g.blog, next_cursor=next_cursor)
+
+def fix_ownership(new_owner_id):
+  """give pages and files whose author/owner no longer exists to new_owner_id
+  (left behind by hard deletes that didn't reassign them)
+  returns (pages fixed, files fixed)
+  """
+  users = User.select(User.id)
+  with DB.atomic():
+    pages = Page.update(author=new_owner_id).where(~(Page.author << users)).execute()
+    files = File.update(owner=new_owner_id).where(~(File.owner << users)).execute()
+  invalidate_page_cache()
+  return pages, files
+
+def remake_image_variants():
+  """make the image variants missing from storage (uploads stored before they
+  moved to storage.VARIANT_DIR, or while Pillow wasn't installed) and remove
+  those the old layout kept beside the upload as <variant>.<filename>, unless
+  that name is itself an upload
+  returns (images done, old variants removed)
+  """
+  upload_folder = app.config['UPLOAD_FOLDER']
+  stored = set(filepath for filepath, in File.select(File.filepath).distinct().tuples())
+  images = removed = 0
+  for filepath in sorted(stored):
+    if not storage.is_image(filepath):
+      continue
+    path = os.path.join(upload_folder, filepath)
+    if not os.path.isfile(path):
+      continue
+    storage.make_variants(path, IMAGE_VARIANTS)
+    images += 1
+    directory, filename = os.path.split(filepath)
+    for variant in IMAGE_VARIANTS:
+      old = os.path.join(directory, '{}.{}'.format(variant, filename))
+      if old not in stored and os.path.isfile(os.path.join(upload_folder, old)):
+        os.remove(os.path.join(upload_folder, old))
+        removed += 1
+  return images, removed
+
+def delete_user_job(user_id, new_owner_id):
+  """User.delete_reassigning on a background thread (it has its own connection)"""
+  try:
+    user = User.get(User.id==user_id)
+    pages, files = user.delete_reassigning(new_owner_id)
+    app.logger.info("user %s deleted, %s pages and %s files reassigned to user %s",
+                    user.username, pages, files, new_owner_id)
+  finally:
+    if not DB.is_closed():
+      DB.close()
     
 @app.route('/user_delete/<int:user_id>')
 @app.route('/user_delete/<int:user_id>/<hard_delete>')
@@ -395,13 +1499,19 @@ def user_delete(user_id, hard_delete=False):
   user = get_object_or_404(User, user_id)
   if user.id != session.get('user_id'):
     if hard_delete:
-      # reassign all pages to admin who is deleting
-      pages = Page.select().where(Page.author==user.id)
-      for page in pages:
-        page.author = session.get('user_id')
-        page.save()
-      user.delete_instance()
-      flash("User fully deleted", category="primary")
+      # reassign all pages and files to admin who is deleting
+      pages = Page.select().where(Page.author==user.id).count()
+      files = File.select().where(File.owner==user.id).count()
+      if pages + files > USER_DELETE_BACKGROUND_ROWS:
+        # no more logins meanwhile
+        User.update(is_active=False).where(User.id==user.id).execute()
+        background_jobs.submit(delete_user_job, user.id, session.get('user_id'))
+        flash("User is being deleted in the background, {} pages and {} files will be "
+              "reassigned to you".format(pages, files), category="primary")
+      else:
+        pages, files = user.delete_reassigning(session.get('user_id'))
+        flash("User fully deleted, {} pages and {} files reassigned to you".format(pages, files),
+              category="primary")
     else:
       user.is_active = False
       user.save()
@@ -422,11 +1532,14 @@ def page_view(page_id):
   s = request.args.get('s')
   if s:
     return redirect( url_for('search', s=s) )  
-  page = get_object_or_404(Page, page_id)
-  if page.is_published:
-    return render_template('page_view.html', page=page)
-  flash('That page id is not published, check back later.', category="warning")
-  return redirect(url_for('index'))
+  entry = page_cache_get(('id', page_id))
+  if entry is None:
+    page = get_object_or_404(Page, page_id)
+    if not page.is_published:
+      flash('That page id is not published, check back later.', category="warning")
+      return redirect(url_for('index'))
+    entry = page_cache_render(('id', page_id), page)
+  return page_cache_response(entry)
 
 @app.route('/page_create')
 @login_required
@@ -483,7 +1596,11 @@ def page_edit(page_id=None):
       page.show_sidebar = show_sidebar
       page.show_nav = show_nav
       page.show_title = show_title
-      page.save()
+      try:
+        page.save()
+      except IntegrityError:
+        flash("Another page already uses that slug, please choose another.", category="danger")
+        return render_template('page_edit.html', page=page)
       flash("Page saved.", category="success")
       return redirect(url_for('index'))
     else:
@@ -496,7 +1613,8 @@ def page_edit(page_id=None):
 @admin_required
 def admin():
   """view for basic admin tasks"""
-  blog = BlogMeta.select()[0]
+  # edit a fresh copy, the cached BlogMeta is only replaced once saved
+  blog = BlogMeta.select().first()
   if request.method == 'POST':
     brand = request.form.get('brand','')
     about = request.form.get('about','')
@@ -511,28 +1629,90 @@ def admin():
   return render_template('admin.html', blog=blog)
 
 
+@app.route('/admin/export/<model>', strict_slashes=False)
 @app.route('/admin/export/<model>/<filename>')
 @admin_required
-def export_model(model, filename):
-  """view exports a named model to a JSON file on the physical file system
-  this view should be used with caution since it doesn't put a limitation on filename/location
-  theoretically could overwrite a critical file.  I haven't tried this yet.
-  TODO - the file should be served up (downloaded to user client)
+def export_model(model, filename=None):
+  """view streams a named model ("user", "page", "file" or "blog") down as a file download
+  the filename extension picks the format: .json is a JSON array, anything else
+  (.ndjson by default) is one JSON object per line; a trailing .gz gzips it.
+  Rows are read and sent in chunks so memory stays flat for any table size.
   """
-  if model == 'user':
-    query = User.select()
-  else:
-    query = Page.select()
-  query_to_file(query, filename)
-  return "Done"
+  models = {'user': User, 'page': Page, 'file': File, 'blog': BlogMeta}
+  if model not in models:
+    abort(404)
+  filename = secure_filename(filename or '{}s.ndjson'.format(model))
+  compress = filename.endswith('.gz')
+  ndjson = not filename[:-3 if compress else None].endswith('.json')
+  query = models[model].select().order_by(models[model].id)
+  extra = ()
+  owner_field = OWNER_FIELDS.get(models[model])
+  if owner_field is not None:
+    # the username goes with each row, so imports can find the user by it
+    extra = (owner_field.name + '_username',)
+    query = (models[model].select(models[model], User.username.alias(extra[0]))
+             .join(User, JOIN.LEFT_OUTER, on=(owner_field == User.id))
+             .order_by(models[model].id).naive())
+  
+  def generate():
+    # the request's connection is closed before the body is streamed,
+    # so the export runs on its own
+    with DB.execution_context(with_transaction=False):
+      chunks = query_to_chunks(query, ndjson=ndjson, extra=extra)
+      if compress:
+        chunks = gzip_chunks(chunks)
+      for chunk in chunks:
+        yield chunk
+  
+  mimetype = 'application/gzip' if compress else (
+    'application/x-ndjson' if ndjson else 'application/json')
+  response = Response(generate(), mimetype=mimetype)
+  response.headers['Content-Disposition'] = 'attachment; filename="{}"'.format(filename)
+  return response
     
   
+@app.route('/admin/import', methods=('POST',))
+@admin_required
+def import_model():
+  """view bulk loads an uploaded export (see export_model) of users, pages or files
+  authors/owners are found by username, ones that don't exist here are
+  reassigned to the importing admin
+  """
+  model = IMPORT_MODELS.get(request.form.get('model'))
+  upload = request.files.get('file')
+  if model is None or not upload or upload.filename == '':
+    flash("Choose what to import and an export file.", category="danger")
+    return redirect(url_for('admin'))
+  try:
+    count, elapsed = bulk_import(model, iter_json_records(upload.stream),
+                                 default_owner=session.get('user_id'))
+  except (ValueError, KeyError) as e:
+    flash("Import failed, the file doesn't look like an export: {}".format(e), category="danger")
+    return redirect(url_for('admin'))
+  flash("{} rows imported in {:.1f}s ({:.0f} rows/sec)".format(
+    count, elapsed, count / max(elapsed, 1e-6)), category="success")
+  return redirect(url_for('admin'))
+  
+@app.route('/admin/metrics')
+@admin_required
+def admin_metrics():
+  """ADMIN-ONLY view of the request metrics (see METRICS_ENABLED)
+  ?format=prometheus returns them in the Prometheus text format
+  """
+  if request_metrics is None:
+    flash("Request metrics are off, start the blog with BLOG_METRICS=1.", category="warning")
+    return redirect(url_for('admin'))
+  if request.args.get('format') == 'prometheus':
+    return Response(request_metrics.prometheus(), mimetype='text/plain; version=0.0.4')
+  return render_template('metrics.html', metrics=request_metrics)
+
 @app.route('/admin/users', methods=('GET','POST'))
 @admin_required
 def admin_users():
   """view for administering users"""
-  users = User.select()
-  return render_template('users.html', users=users)
+  users, next_cursor = paginate_keyset(UserRow.select(), User, request.args.get('after'),
+                                       LISTING_PAGE_SIZE, row=UserRow.from_tuple)
+  return render_template('users.html', users=users, next_cursor=next_cursor)
 
 @app.route('/admin/user/add', strict_slashes=False)
 @admin_required
@@ -579,8 +1759,9 @@ def admin_pages():
   """ADMIN-ONLY view to look at all pages.
   TODO: change view to support non-admin users
   """
-  pages = Page.select()
-  return render_template('admin_pages.html', pages=pages)
+  pages, next_cursor = paginate_keyset(PageRow.select(), Page, request.args.get('after'),
+                                       LISTING_PAGE_SIZE, row=PageRow.from_tuple)
+  return render_template('admin_pages.html', pages=pages, next_cursor=next_cursor)
 
 
 @app.route('/file_delete/<int:file_id>')
@@ -592,7 +1773,9 @@ def file_delete(file_id):
   if f.owner.id == session['user_id'] or session['is_admin']:
     f.delete_instance()
     try:
-      os.remove(pathname)
+      # the stored file may be shared with other File rows
+      if not File.select().where(File.filepath==f.filepath).exists():
+        storage.discard(pathname)
       flash('File Successfully Deleted', category="success")
     except:
       flash("Error: problems removing physical file. Check log for details.", category="warning")
@@ -632,14 +1815,15 @@ def admin_files():
   """ADMIN-ONLY view for all File resources
   TODO: change this view to support non-admin users
   """
-  files = File.select()
-  return render_template('admin_files.html', files=files)
+  files, next_cursor = paginate_keyset(File.with_owners(), File,
+                                       request.args.get('after'), LISTING_PAGE_SIZE)
+  return render_template('admin_files.html', files=files, next_cursor=next_cursor)
 
 @app.route('/admin/firstuse', methods=('GET', 'POST'))
 def admin_first_use():
   """view for first-use.  This view is triggered by EMPTY User table"""
   # this route should only work on empty user table
-  if len(User.select()) > 0:
+  if User.select().exists():
     abort(403) # forbidden
   
   errors = False
@@ -663,14 +1847,50 @@ def admin_first_use():
   return render_template('first_use.html')
 
 
+@app.route('/feed.xml')
+def feed():
+  """RSS feed of the FEED_SIZE newest published pages"""
+  def build():
+    pages = Page.select().where(Page.is_published==True).limit(FEED_SIZE)
+    return render_template('feed.xml', pages=pages, blog=g.blog).encode('utf-8')
+  return feed_response('feed', build, 'application/rss+xml')
+
+@app.route('/sitemap.xml')
+@app.route('/sitemap-<int:part>.xml')
+def sitemap(part=None):
+  """sitemap of the published pages. Past SITEMAP_MAX_URLS pages /sitemap.xml
+  is a sitemap index and the urls are split over /sitemap-<1..n>.xml
+  """
+  def build():
+    published = Page.select(Page.id, Page.slug).where(Page.is_published==True).order_by(Page.id)
+    parts = max(int(math.ceil(published.count() / float(SITEMAP_MAX_URLS))), 1)
+    if part is None and parts > 1:
+      urls = [url_for('sitemap', part=n, _external=True) for n in range(1, parts + 1)]
+      return render_template('sitemap_index.xml', urls=urls).encode('utf-8')
+    if part is not None and not 1 <= part <= parts:
+      return None
+    rows = published.offset(((part or 1) - 1) * SITEMAP_MAX_URLS).limit(SITEMAP_MAX_URLS)
+    page_url = page_external_url_builder()
+    urls = (page_url(page_id, slug) for page_id, slug in rows.tuples().iterator())
+    return render_template('sitemap.xml', urls=urls).encode('utf-8')
+  return feed_response(('sitemap', part), build)
+
 @app.route("/search")
 def search():
-  """a general search view
+  """a general search view, results are ranked by the full-text index
+  ?s=<term>&p=<page number>
   TODO: improve search results to be Page cards like index
   """
-  search_term = request.args.get('s')
-  pages = Page.select().where(Page.content.contains(search_term) | Page.title.contains(search_term) | Page.slug.contains(search_term))
-  return render_template('search.html', pages=pages, search_term=search_term)
+  search_term = request.args.get('s', '')
+  try:
+    page_number = min(max(int(request.args.get('p', 1)), 1), SEARCH_MAX_PAGES)
+  except ValueError:
+    page_number = 1
+  pages = PageIndex.search_pages(search_term, page_number)
+  has_next = len(pages) > SEARCH_PAGE_SIZE
+  return render_template('search.html', pages=pages[:SEARCH_PAGE_SIZE], search_term=search_term,
+                         page_number=page_number, has_next=has_next,
+                         start=(page_number - 1) * SEARCH_PAGE_SIZE + 1)
 
 # this is the general route "catchment"
 @app.route("/")
@@ -688,15 +1908,21 @@ def site(path=None):
     """modify here to change behavior of the home-index"""
     return redirect(url_for("index"))
   
-  page = Page.select().where(Page.slug==path)
-  if len(page) > 0:
-    page = page[0]
-  else:
-    abort(404)
+  entry = page_cache_get(('slug', path))
+  if entry is None:
+    # unknown paths (bots probe plenty) 404 straight from the slug map
+    page_id = slug_map().get(path)
+    if page_id is None:
+      abort(404)
+    page = Page.with_authors().where(Page.id==page_id).first()
+    if page is None:
+      abort(404)
+    entry = page_cache_render(('slug', path), page)
     
-  return render_template('page_view.html', page=page)   
+  return page_cache_response(entry)
 
 if __name__ == '__main__':
-  """launched from the command line, you pass args to initialize, then run the app"""
+  """launched from the command line, you pass args to initialize, then run the app
+  (the development server, see wsgi.py for serving in production)"""
   initialize(sys.argv)
   app.run(host=HOST, port=PORT, debug=DEBUG)
\ No newline at end of file
@@ -0,0 +1,191 @@
+"""opt-in request instrumentation: per-endpoint wall time, SQL query count
+and time, template render time, with an optional cProfile sampler that
+keeps the profiles of slow requests.
+
+metrics = RequestMetrics()
+metrics.install(app, DB)
+
+Collected histograms are shown by the /admin/metrics view and are available
+in the Prometheus text format (see RequestMetrics.prometheus). Template
+render time comes from Flask's signals, so it needs blinker installed.
+"""
+import time, random, threading, cProfile, pstats, io
+from collections import deque
+from flask import request, g, has_request_context
+
+try:
+  from flask import before_render_template, template_rendered, signals_available
+except ImportError:
+  signals_available = False
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+
+class Histogram(object):
+  """cumulative bucket histogram (Prometheus style) with count and sum"""
+  def __init__(self, buckets):
+    self.buckets = buckets
+    self.counts = [0] * len(buckets)
+    self.count = 0
+    self.sum = 0.0
+
+  def observe(self, value):
+    self.count += 1
+    self.sum += value
+    for i, bound in enumerate(self.buckets):
+      if value <= bound:
+        self.counts[i] += 1
+
+  @property
+  def mean(self):
+    return self.sum / self.count if self.count else 0.0
+
+  def quantile(self, q):
+    """upper bound of the bucket holding the q quantile (inf past the last one)"""
+    if not self.count:
+      return 0.0
+    rank = q * self.count
+    for bound, cumulative in zip(self.buckets, self.counts):
+      if cumulative >= rank:
+        return bound
+    return float('inf')
+
+
+class EndpointStats(object):
+  def __init__(self):
+    self.wall = Histogram(SECONDS_BUCKETS)
+    self.sql_count = Histogram(COUNT_BUCKETS)
+    self.sql_time = Histogram(SECONDS_BUCKETS)
+    self.template_time = Histogram(SECONDS_BUCKETS)
+    self.statuses = {}
+
+
+class RequestMetrics(object):
+  """collects per-endpoint request metrics for a Flask app and a peewee database
+
+  profile_rate - fraction of requests run under cProfile (0 disables)
+  slow_seconds - profiled requests slower than this keep their profile
+  keep_profiles - how many slow request profiles are kept (newest first)
+  """
+  def __init__(self, profile_rate=0.0, slow_seconds=0.5, keep_profiles=10):
+    self.profile_rate = profile_rate
+    self.slow_seconds = slow_seconds
+    self.endpoints = {}
+    self.slow_profiles = deque(maxlen=keep_profiles)
+    self.started = time.time()
+    self._lock = threading.Lock()
+    self._local = threading.local()
+
+  def install(self, app, database):
+    # first in line, so timing starts even if a later hook aborts the request
+    app.before_request_funcs.setdefault(None, []).insert(0, self._before_request)
+    app.after_request(self._after_request)
+    app.teardown_request(self._teardown_request)
+    self._wrap_execute_sql(database)
+    if signals_available:
+      before_render_template.connect(self._before_render, app, weak=False)
+      template_rendered.connect(self._after_render, app, weak=False)
+
+  def _wrap_execute_sql(self, database):
+    execute_sql = database.execute_sql
+    local = self._local
+    def timed_execute_sql(*args, **kwargs):
+      if not getattr(local, 'active', False):
+        return execute_sql(*args, **kwargs)
+      started = time.time()
+      try:
+        return execute_sql(*args, **kwargs)
+      finally:
+        local.sql_count += 1
+        local.sql_time += time.time() - started
+    database.execute_sql = timed_execute_sql
+
+  def _before_request(self):
+    local = self._local
+    local.active = True
+    local.sql_count = 0
+    local.sql_time = 0.0
+    local.template_time = 0.0
+    local.render_started = []
+    local.profiler = None
+    if self.profile_rate and random.random() < self.profile_rate:
+      local.profiler = cProfile.Profile()
+      local.profiler.enable()
+    local.started = time.time()
+
+  def _after_request(self, response):
+    g.metrics_status = response.status_code
+    return response
+
+  def _teardown_request(self, exception):
+    local = self._local
+    if not getattr(local, 'active', False):
+      return
+    wall = time.time() - local.started
+    local.active = False
+    endpoint = request.endpoint or 'unmatched'
+    status = getattr(g, 'metrics_status', 500)
+    with self._lock:
+      stats = self.endpoints.get(endpoint)
+      if stats is None:
+        stats = self.endpoints[endpoint] = EndpointStats()
+      stats.wall.observe(wall)
+      stats.sql_count.observe(local.sql_count)
+      stats.sql_time.observe(local.sql_time)
+      stats.template_time.observe(local.template_time)
+      stats.statuses[status] = stats.statuses.get(status, 0) + 1
+    if local.profiler is not None:
+      local.profiler.disable()
+      if wall >= self.slow_seconds:
+        self.slow_profiles.appendleft(self._profile_report(local.profiler, wall))
+      local.profiler = None
+
+  def _profile_report(self, profiler, wall):
+    out = io.BytesIO() if str is bytes else io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(25)
+    return {'path': request.path, 'endpoint': request.endpoint, 'seconds': wall,
+            'at': time.time(), 'report': out.getvalue()}
+
+  def _before_render(self, sender, **extra):
+    if has_request_context() and getattr(self._local, 'active', False):
+      self._local.render_started.append(time.time())
+
+  def _after_render(self, sender, **extra):
+    if has_request_context() and getattr(self._local, 'active', False) and self._local.render_started:
+      # a template rendered while rendering another is already timed by the outer one
+      started = self._local.render_started.pop()
+      if not self._local.render_started:
+        self._local.template_time += time.time() - started
+
+  def summary(self):
+    """[(endpoint, EndpointStats)] sorted by total wall time, busiest first"""
+    with self._lock:
+      return sorted(self.endpoints.items(), key=lambda item: -item[1].wall.sum)
+
+  def prometheus(self):
+    """all histograms in the Prometheus text exposition format"""
+    lines = []
+    metrics = [
+      ('flaskblog_request_seconds', 'wall time per request', 'wall'),
+      ('flaskblog_request_sql_queries', 'SQL statements per request', 'sql_count'),
+      ('flaskblog_request_sql_seconds', 'time in SQL per request', 'sql_time'),
+      ('flaskblog_request_template_seconds', 'template render time per request', 'template_time'),
+    ]
+    summary = self.summary()
+    for name, help_text, attr in metrics:
+      lines.append('# HELP {} {}'.format(name, help_text))
+      lines.append('# TYPE {} histogram'.format(name))
+      for endpoint, stats in summary:
+        hist = getattr(stats, attr)
+        for bound, cumulative in zip(hist.buckets, hist.counts):
+          lines.append('{}_bucket{{endpoint="{}",le="{}"}} {}'.format(name, endpoint, bound, cumulative))
+        lines.append('{}_bucket{{endpoint="{}",le="+Inf"}} {}'.format(name, endpoint, hist.count))
+        lines.append('{}_sum{{endpoint="{}"}} {}'.format(name, endpoint, hist.sum))
+        lines.append('{}_count{{endpoint="{}"}} {}'.format(name, endpoint, hist.count))
+    lines.append('# HELP flaskblog_responses_total responses by endpoint and status')
+    lines.append('# TYPE flaskblog_responses_total counter')
+    for endpoint, stats in summary:
+      for status, count in sorted(stats.statuses.items()):
+        lines.append('flaskblog_responses_total{{endpoint="{}",status="{}"}} {}'.format(endpoint, status, count))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,168 @@
+"""upload storage: streamed, hashed saves with content-addressed dedup
+and image variants (thumbnails) made on a background thread pool.
+
+Uploads are laid out as UPLOAD_FOLDER/YYYYMM/<digest[:16]>/<filename>, so a
+path is decided by the bytes themselves and can never collide with different
+content. Identical bytes already stored under another name are hardlinked
+rather than written again. Variants of an upload (thumbnails, compressed
+copies) live in its digest directory's VARIANT_DIR as <variant>.<filename>;
+uploaded names never start with a dot (secure_filename strips them), so no
+upload can land there or be taken for a variant.
+"""
+import os, errno, hashlib, tempfile, threading, logging
+from multiprocessing.pool import ThreadPool
+
+try:
+  from PIL import Image
+except ImportError:
+  # thumbnails are optional, without Pillow no variants are made
+  Image = None
+
+CHUNK_SIZE = 64 * 1024
+VARIANT_DIR = '.variants'
+IMAGE_EXTENSIONS = set(['png', 'jpg', 'jpeg', 'gif'])
+
+def receive(stream, folder, chunk_size=CHUNK_SIZE):
+  """copy an upload stream in chunks to a temp file in folder, hashing as it goes
+  returns (temp path, sha256 hex digest, size in bytes)
+  """
+  ensure_dir(folder)
+  digest = hashlib.sha256()
+  size = 0
+  fd, temp_path = tempfile.mkstemp(prefix='.incoming-', dir=folder)
+  try:
+    with os.fdopen(fd, 'wb') as fp:
+      while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+          break
+        digest.update(chunk)
+        size += len(chunk)
+        fp.write(chunk)
+  except:
+    os.remove(temp_path)
+    raise
+  return temp_path, digest.hexdigest(), size
+
+def content_path(subfolder, digest, filename):
+  """relative path for an upload, derived from its content digest"""
+  return os.path.join(subfolder, digest[:16], filename)
+
+def place(temp_path, target, existing=None):
+  """move a received upload (see receive) to target.
+  If target is already there it holds these same bytes, and if existing (a path
+  to the same bytes under another name) is given it's hardlinked instead of
+  storing a second copy; either way the temp file is dropped.
+  """
+  if os.path.isfile(target):
+    os.remove(temp_path)
+    return
+  ensure_dir(os.path.dirname(target))
+  if existing and os.path.isfile(existing):
+    try:
+      os.link(existing, target)
+      os.remove(temp_path)
+      return
+    except OSError as e:
+      if e.errno == errno.EEXIST:
+        # another request placed it meanwhile
+        os.remove(temp_path)
+        return
+      # filesystem without hardlinks, keep our own copy
+  os.rename(temp_path, target)
+
+def discard(path):
+  """remove a stored upload, all its variants and its (now empty) digest directory"""
+  directory, filename = os.path.split(path)
+  variant_dir = os.path.join(directory, VARIANT_DIR)
+  names = [os.path.join(directory, filename)]
+  if os.path.isdir(variant_dir):
+    # variant names have no dots, so <variant>.<filename> is only ever this upload's
+    names += [os.path.join(variant_dir, name) for name in os.listdir(variant_dir)
+              if name.split('.', 1)[-1] == filename and not name.startswith('.')]
+  for name in names:
+    try:
+      os.remove(name)
+    except OSError as e:
+      if e.errno != errno.ENOENT:
+        raise
+  for name in (variant_dir, directory):
+    try:
+      os.rmdir(name)
+    except OSError:
+      pass  # not empty, another name is stored there
+
+def variant_path(path, variant):
+  """where the variant (a name without dots) of the upload at path is kept"""
+  directory, filename = os.path.split(path)
+  return os.path.join(directory, VARIANT_DIR, '{}.{}'.format(variant, filename))
+
+def write_variant(target, data_writer):
+  """write a variant through data_writer(fp) to a temp name beside target, then
+  rename it in place so a half-written variant is never served"""
+  ensure_dir(os.path.dirname(target))
+  fd, temp = tempfile.mkstemp(prefix='.variant-', dir=os.path.dirname(target))
+  try:
+    with os.fdopen(fd, 'wb') as fp:
+      data_writer(fp)
+    os.rename(temp, target)
+  except:
+    os.remove(temp)
+    raise
+
+def ensure_dir(directory):
+  try:
+    os.makedirs(directory)
+  except OSError as e:
+    if e.errno != errno.EEXIST:
+      raise
+
+def is_image(filename):
+  return '.' in filename and filename.rsplit('.', 1)[1].lower() in IMAGE_EXTENSIONS
+
+def make_variants(path, variants):
+  """write resized copies of the image at path, variants is {name: (width, height)}"""
+  if Image is None:
+    return
+  for name, size in variants.items():
+    target = variant_path(path, name)
+    if os.path.isfile(target):
+      continue
+    image = Image.open(path)
+    image.thumbnail(size)
+    write_variant(target, lambda fp: image.save(fp, format=image.format))
+
+
+class VariantWorker(object):
+  """background thread pool making image variants, so uploads return at once"""
+  def __init__(self, variants, processes=2, logger=None):
+    self.variants = variants
+    self.processes = processes
+    self.logger = logger or logging.getLogger(__name__)
+    self._pool = None
+    self._lock = threading.Lock()
+
+  def submit(self, path):
+    """queue variant generation for an uploaded file (non-images are ignored)"""
+    if Image is None or not self.variants or not is_image(path):
+      return None
+    with self._lock:
+      if self._pool is None:
+        # started lazily so importing the app doesn't spawn threads
+        self._pool = ThreadPool(self.processes)
+    return self._pool.apply_async(self._run, (path,))
+
+  def join(self):
+    """wait for the queued variants to be made (the pool starts again on next submit)"""
+    with self._lock:
+      pool, self._pool = self._pool, None
+    if pool is not None:
+      pool.close()
+      pool.join()
+
+  def _run(self, path):
+    try:
+      make_variants(path, self.variants)
+    except Exception:
+      # a broken image shouldn't take the worker down, the original is still served
+      self.logger.exception("image variants failed for %s", path)
@@ -0,0 +1,46 @@
+"""tests for the blog, run them from the repository root:
+python -m unittest discover tests
+
+main reads its database and upload paths from the environment when it's
+imported, so they are pointed at a temp directory before anything imports it.
+"""
+import os, sys, atexit, shutil, tempfile, unittest
+
+WORKDIR = tempfile.mkdtemp(prefix='blog-test-')
+atexit.register(shutil.rmtree, WORKDIR, True)
+os.environ['BLOG_DB_PATH'] = os.path.join(WORKDIR, 'blog.db')
+os.environ['BLOG_UPLOAD_FOLDER'] = os.path.join(WORKDIR, 'uploads')
+os.environ['BLOG_TEMPLATE_CACHE'] = 'off'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+from benchmarks.harness import seed
+
+TABLES = [main.BlogMeta, main.User, main.Page, main.PageIndex, main.File, main.RateBucket]
+
+
+class AppTestCase(unittest.TestCase):
+  """a fresh database (see seed, user 1 is the admin) and empty caches per test"""
+  users, pages, files = 3, 12, 0
+
+  def setUp(self):
+    main.DB.get_conn()
+    main.DB.drop_tables(TABLES, safe=True)
+    shutil.rmtree(os.environ['BLOG_UPLOAD_FOLDER'], ignore_errors=True)
+    main._blog_meta_cache.clear()
+    main.page_cache.clear()
+    main.fragment_cache.clear()
+    main.feed_cache.clear()
+    main.reload_slug_map()
+    for kind, limit in (('user', main.LOGIN_LIMIT_USER), ('addr', main.LOGIN_LIMIT_ADDR)):
+      main._login_buckets[kind] = main.TokenBuckets(*limit)
+    self.rows = seed(main, users=self.users, pages=self.pages, files=self.files)
+    main.DB.get_conn()
+    self.client = main.app.test_client()
+
+  def login(self, user_id=1, is_admin=True):
+    """make the test client's session a logged in one"""
+    with self.client.session_transaction() as session:
+      session.update(is_authenticated=True, is_admin=is_admin, user_id=user_id,
+                     username=main.User.get(main.User.id==user_id).username,
+                     sid=main.new_session_id())
@@ -0,0 +1,45 @@
+"""per-process caches: a change saved while a request renders must not leave
+the old rendering cached"""
+from tests import AppTestCase
+import main
+
+
+class CacheRaceTest(AppTestCase):
+  def meanwhile(self, name, change):
+    """make main.<name> run change() once right after it, as if another request
+    saved something while this one was rendering"""
+    original = getattr(main, name)
+    def patched(*args, **kwargs):
+      result = original(*args, **kwargs)
+      setattr(main, name, original)
+      change()
+      return result
+    setattr(main, name, patched)
+    self.addCleanup(setattr, main, name, original)
+
+  def rename_page(self, page_id):
+    page = main.Page.get(main.Page.id==page_id)
+    page.title = 'Renamed meanwhile'
+    page.save()
+
+  def test_page_saved_while_rendering(self):
+    page = main.Page.select().where(main.Page.is_published==True).first()
+    self.meanwhile('get_object_or_404', lambda: self.rename_page(page.id))
+    url = '/page/{}'.format(page.id)
+    self.assertNotIn('Renamed meanwhile', self.client.get(url).get_data(as_text=True))
+    self.assertIn('Renamed meanwhile', self.client.get(url).get_data(as_text=True))
+
+  def rebrand(self):
+    blog = main.BlogMeta.select().first()
+    blog.brand = 'Rebranded meanwhile'
+    blog.save()
+
+  def test_feed_built_while_rebranding(self):
+    self.meanwhile('render_template', self.rebrand)
+    self.assertNotIn('Rebranded meanwhile', self.client.get('/feed.xml').get_data(as_text=True))
+    self.assertIn('Rebranded meanwhile', self.client.get('/feed.xml').get_data(as_text=True))
+
+  def test_navbar_rendered_while_rebranding(self):
+    self.meanwhile('get_blog_meta', self.rebrand)
+    self.assertNotIn('<strong>Rebranded meanwhile</strong>', self.client.get('/index').get_data(as_text=True))
+    self.assertIn('<strong>Rebranded meanwhile</strong>', self.client.get('/index').get_data(as_text=True))
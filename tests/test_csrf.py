@@ -0,0 +1,48 @@
+"""signed csrf tokens: bound to the session, expiring, not needing a session write per form"""
+import re, time
+from tests import AppTestCase
+import main, utils
+
+TOKEN = re.compile(r'name="_csrf_token" type="hidden" value="([^"]+)"')
+
+
+class CsrfTest(AppTestCase):
+  def token(self, client, url='/login'):
+    return TOKEN.search(client.get(url).get_data(as_text=True)).group(1)
+
+  def post_login(self, client, token):
+    return client.post('/login', data={'_csrf_token': token, 'username': 'admin', 'password': 'admin'})
+
+  def test_login_with_own_token(self):
+    self.assertEqual(self.post_login(self.client, self.token(self.client)).status_code, 302)
+
+  def test_post_without_token(self):
+    self.client.get('/login')
+    self.assertEqual(self.client.post('/login', data={'username': 'admin'}).status_code, 400)
+
+  def test_token_of_another_visitor(self):
+    token = self.token(main.app.test_client())
+    self.assertEqual(self.post_login(self.client, token).status_code, 400)
+    self.client.get('/login')
+    self.assertEqual(self.post_login(self.client, token).status_code, 400)
+
+  def test_expired_token(self):
+    token = self.token(self.client)
+    with self.client.session_transaction() as session:
+      sid = session['sid']
+    with main.app.test_request_context():
+      stamp = int(time.time()) - main.CSRF_MAX_AGE - 1
+      expired = '{}.{}'.format(stamp, utils._csrf_signature(sid, stamp))
+    self.assertEqual(self.post_login(self.client, expired).status_code, 400)
+    self.assertEqual(self.post_login(self.client, token).status_code, 302)
+
+  def test_anonymous_pages_set_no_cookie(self):
+    for url in ('/index', '/page/{}'.format(self.rows['pages'][0]), '/search?s=lorem'):
+      self.assertNotIn('Set-Cookie', self.client.get(url).headers, url)
+
+  def test_tokens_from_several_tabs(self):
+    self.login()
+    tokens = [self.token(self.client, '/page_edit') for _ in range(3)]
+    for token in reversed(tokens):
+      response = self.client.post('/page_edit', data={'_csrf_token': token, 'title': 't', 'content': ''})
+      self.assertNotEqual(response.status_code, 400)
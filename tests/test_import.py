@@ -0,0 +1,81 @@
+"""export -> import round trip of users and pages"""
+import io, re
+from tests import AppTestCase, TABLES
+import main
+from utils import iter_json_records
+
+TOKEN = re.compile(r'name="_csrf_token" type="hidden" value="([^"]+)"')
+
+
+class ImportRoundTripTest(AppTestCase):
+  users, pages = 4, 30
+
+  def export(self, model, filename):
+    response = self.client.get('/admin/export/{}/{}'.format(model, filename))
+    self.assertEqual(response.status_code, 200)
+    return response.get_data()
+
+  def snapshot(self):
+    return sorted((page.title, page.slug, page.content, page.summary, page.author.username)
+                  for page in main.Page.with_authors())
+
+  def round_trip(self, users_file, pages_file):
+    self.login()
+    before = self.snapshot()
+    users, pages = self.export('user', users_file), self.export('page', pages_file)
+    main.DB.drop_tables(TABLES)
+    main.DB.create_tables(TABLES)
+    user_map = {}
+    main.bulk_import(main.User, iter_json_records(io.BytesIO(users)), user_map)
+    count, _ = main.bulk_import(main.Page, iter_json_records(io.BytesIO(pages)), user_map)
+    self.assertEqual(count, self.pages)
+    self.assertEqual(self.snapshot(), before)
+    self.assertEqual(main.PageIndex.select().count(), self.pages)
+
+  def test_ndjson(self):
+    self.round_trip('users.ndjson', 'pages.ndjson')
+
+  def test_gzipped_json_array(self):
+    self.round_trip('users.json.gz', 'pages.json.gz')
+
+  def test_existing_usernames_are_kept(self):
+    self.login()
+    users, pages = self.export('user', 'users.ndjson'), self.export('page', 'pages.ndjson')
+    user_map = {}
+    main.bulk_import(main.User, iter_json_records(io.BytesIO(users)), user_map)
+    self.assertEqual(main.User.select().count(), self.users)
+    main.bulk_import(main.Page, iter_json_records(io.BytesIO(pages)), user_map)
+    # imported again, clashing slugs get a suffix
+    self.assertEqual(main.Page.select().count(), 2 * self.pages)
+    self.assertEqual(len(main.slug_map()), 2 * self.pages)
+
+  def test_separate_uploads_find_authors_by_username(self):
+    self.login()
+    before = self.snapshot()
+    users, pages = self.export('user', 'users.ndjson'), self.export('page', 'pages.ndjson')
+    # a blog whose user ids belong to other people
+    main.DB.drop_tables(TABLES)
+    main.DB.create_tables(TABLES)
+    for username in ('admin', 'dave', 'user3', 'erin', 'user1'):
+      main.User.create(username=username, password='x', is_admin=username == 'admin')
+    self.login()
+    for model, data in (('users', users), ('pages', pages)):
+      token = TOKEN.search(self.client.get('/admin').get_data(as_text=True)).group(1)
+      response = self.client.post('/admin/import', data={
+        '_csrf_token': token, 'model': model, 'file': (io.BytesIO(data), model + '.ndjson')})
+      self.assertEqual(response.status_code, 302)
+    self.assertEqual(self.snapshot(), before)
+
+  def test_unknown_author_goes_to_the_default_owner(self):
+    self.login()
+    before = self.snapshot()
+    pages = self.export('page', 'pages.ndjson')
+    main.DB.drop_tables(TABLES)
+    main.DB.create_tables(TABLES)
+    # no admin here, and user1..3 exist under other ids than they had
+    for username in ('root', 'user3', 'user2', 'user1'):
+      main.User.create(username=username, password='x')
+    main.bulk_import(main.Page, iter_json_records(io.BytesIO(pages)), default_owner=1)
+    expected = sorted(row[:4] + ('root' if row[4] == 'admin' else row[4],) for row in before)
+    self.assertIn('admin', [row[4] for row in before])
+    self.assertEqual(self.snapshot(), expected)
@@ -0,0 +1,54 @@
+"""password rehashing on login and login throttling"""
+import re
+from tests import AppTestCase
+import main
+from utils import hash_password
+
+TOKEN = re.compile(r'name="_csrf_token" type="hidden" value="([^"]+)"')
+
+
+class LoginTest(AppTestCase):
+  def post_login(self, password, username='admin'):
+    token = TOKEN.search(self.client.get('/login').get_data(as_text=True)).group(1)
+    return self.client.post('/login', data={'_csrf_token': token, 'username': username,
+                                            'password': password})
+
+  def stored_hash(self):
+    return main.User.get(main.User.username=='admin').password
+
+  def test_old_hash_is_upgraded(self):
+    main.User.update(password=hash_password('admin', 'pbkdf2:sha256:1000', 8)).execute()
+    self.assertEqual(self.post_login('admin').status_code, 302)
+    upgraded = self.stored_hash()
+    self.assertEqual(upgraded.split('$')[0], main.PASSWORD_METHOD)
+    # logging in with a current hash leaves it alone
+    self.assertEqual(self.post_login('admin').status_code, 302)
+    self.assertEqual(self.stored_hash(), upgraded)
+
+  def test_method_without_iterations_is_current(self):
+    main.User.update(password=hash_password('admin', 'pbkdf2:sha256', 8)).execute()
+    stored = self.stored_hash()
+    original, main.PASSWORD_METHOD = main.PASSWORD_METHOD, 'pbkdf2:sha256'
+    try:
+      self.assertEqual(self.post_login('admin').status_code, 302)
+    finally:
+      main.PASSWORD_METHOD = original
+    self.assertEqual(self.stored_hash(), stored)
+
+  def assertThrottled(self):
+    burst = main.LOGIN_LIMIT_USER[0]
+    for _ in range(burst):
+      self.assertEqual(self.post_login('wrong').status_code, 200)
+    response = self.post_login('admin')
+    self.assertEqual(response.status_code, 429)
+    self.assertGreater(int(response.headers['Retry-After']), 0)
+
+  def test_throttled_in_memory(self):
+    self.assertThrottled()
+
+  def test_throttled_in_database(self):
+    original, main.LOGIN_LIMITER = main.LOGIN_LIMITER, 'db'
+    try:
+      self.assertThrottled()
+    finally:
+      main.LOGIN_LIMITER = original
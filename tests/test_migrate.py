@@ -0,0 +1,19 @@
+"""--migrate brings a database made by an older version up to date"""
+from tests import AppTestCase
+import main
+
+
+class MigrateTest(AppTestCase):
+  def columns(self):
+    return [column.name for column in main.DB.get_columns('page')]
+
+  def test_drops_plain_text(self):
+    # as the version that kept a copy of the text without tags had it
+    main.DB.execute_sql("ALTER TABLE page ADD COLUMN plain_text TEXT NOT NULL DEFAULT ''")
+    main.migrate_schema()
+    self.assertNotIn('plain_text', self.columns())
+    self.assertIn('page_slug', [index.name for index in main.DB.get_indexes('page')])
+    page = main.Page.create(author=1, title='after', content='<p>migrated fine</p>')
+    self.assertEqual(main.Page.get(main.Page.id==page.id).snippet(), 'migrated fine')
+    main.migrate_schema()
+    self.assertEqual(len(main.PageIndex.search_pages('migrated')), 1)
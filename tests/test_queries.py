@@ -0,0 +1,36 @@
+"""SQL statements per listing request, so an N+1 (a query per row shown) fails here"""
+import re
+# first, it points main at the test database before main is imported
+from tests import AppTestCase
+import main
+from utils import QueryCounter
+
+
+class ListingQueryCountTest(AppTestCase):
+  # more pages than any listing shows, so a per-row query would be counted many times
+  pages = 60
+
+  def assertQueries(self, url, limit):
+    self.client.get(url)  # first requests load per-process caches
+    with QueryCounter(main.DB, limit=limit):
+      response = self.client.get(url)
+    self.assertEqual(response.status_code, 200)
+    return response
+
+  def test_index(self):
+    # has any user (first use check) + the page of cards
+    response = self.assertQueries('/index', 2)
+    older = re.search(r'after=([\w-]+)', response.get_data(as_text=True)).group(1)
+    self.assertQueries('/index?after=' + older, 2)
+
+  def test_admin_pages(self):
+    self.login()
+    self.assertQueries('/admin/pages', 1)
+
+  def test_admin_users(self):
+    self.login()
+    self.assertQueries('/admin/users', 1)
+
+  def test_search(self):
+    self.assertQueries('/search?s=lorem', 1)
+    self.assertQueries('/search?s=lorem&p=2', 1)
@@ -0,0 +1,62 @@
+"""stored uploads and their variants (compressed copies, thumbnails)"""
+import io, os, re
+from tests import AppTestCase
+import main
+
+TEXT = b'the same words over and over. ' * 200
+
+
+class UploadVariantTest(AppTestCase):
+  def upload(self, filename, data=TEXT):
+    response = self.client.post('/upload', data={
+      '_csrf_token': self.token, 'file': (io.BytesIO(data), filename)})
+    self.assertEqual(response.status_code, 302)
+    return main.File.select().order_by(main.File.id.desc()).first()
+
+  def setUp(self):
+    super(UploadVariantTest, self).setUp()
+    self.login()
+    form = self.client.get('/upload').get_data(as_text=True)
+    self.token = re.search(r'name=_csrf_token value="([^"]+)"', form).group(1)
+
+  def get(self, f, **headers):
+    return self.client.get('/uploads/' + f.filepath, headers=headers)
+
+  def test_upload_named_like_a_variant(self):
+    notes = self.upload('notes.txt')
+    self.assertEqual(self.get(notes, **{'Accept-Encoding': 'gzip'}).headers['Content-Encoding'], 'gzip')
+    lookalike = self.upload('gzip.notes.txt')
+    self.assertEqual(self.get(notes).get_data(), TEXT)
+    self.assertEqual(self.get(lookalike).get_data(), TEXT)
+    self.client.get('/file_delete/{}'.format(lookalike.id))
+    self.assertEqual(self.get(notes).get_data(), TEXT)
+    response = self.get(notes, **{'Accept-Encoding': 'gzip'})
+    self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+
+  def test_delete_removes_variants(self):
+    notes = self.upload('notes.txt')
+    self.get(notes, **{'Accept-Encoding': 'gzip'})
+    path = os.path.join(main.app.config['UPLOAD_FOLDER'], notes.filepath)
+    self.assertTrue(os.path.isfile(main.storage.variant_path(path, 'gzip')))
+    self.client.get('/file_delete/{}'.format(notes.id))
+    self.assertFalse(os.path.exists(os.path.dirname(path)))
+
+  def test_thumbnails_of_the_old_layout(self):
+    from PIL import Image
+    data = io.BytesIO()
+    Image.new('RGB', (400, 300)).save(data, format='PNG')
+    photo = self.upload('photo.png', data.getvalue())
+    lookalike = self.upload('thumb.photo.png', data.getvalue())
+    main.image_variants.join()
+    path = os.path.join(main.app.config['UPLOAD_FOLDER'], photo.filepath)
+    thumb = main.storage.variant_path(path, 'thumb')
+    self.assertEqual(Image.open(thumb).size, (200, 150))
+    # a thumbnail where the old layout kept it, and none in the new one
+    os.remove(thumb)
+    old = os.path.join(os.path.dirname(path), 'medium.photo.png')
+    with open(old, 'wb') as fp:
+      fp.write(b'old thumbnail')
+    self.assertEqual(main.remake_image_variants(), (2, 1))
+    self.assertEqual(Image.open(thumb).size, (200, 150))
+    self.assertFalse(os.path.exists(old))
+    self.assertEqual(self.get(lookalike).get_data(), data.getvalue())
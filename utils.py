@@ -1,9 +1,18 @@
 
 from functools import wraps
-import os, json, re, string, random
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+import os, json, re, time, threading, datetime, zlib, gzip, codecs, hmac, hashlib, binascii, sqlite3, tempfile, logging
 from HTMLParser import HTMLParser
-from flask import abort, redirect, request, session, url_for, jsonify
+from flask import abort, redirect, request, session, url_for, jsonify, current_app
+from markupsafe import Markup, escape
+from jinja2 import nodes
+from jinja2.ext import Extension
 from playhouse.shortcuts import model_to_dict, dict_to_model
+from peewee import Tuple, TextField, FieldDescriptor
+from werkzeug.security import generate_password_hash, check_password_hash
+
+CURSOR_FORMAT = '%Y%m%d%H%M%S%f'
 
 def get_object_or_404(cls, object_id):
   try:
@@ -17,13 +26,42 @@ def get_object_of_none(cls, object_id):
   except:
     return None
   
-def token_generator(size=12, chars=string.ascii_uppercase + string.digits):
-  return ''.join(random.choice(chars) for _ in range(size))
+def new_session_id():
+  """random id stored in the session at login, csrf tokens are bound to it"""
+  return binascii.hexlify(os.urandom(16)).decode('ascii')
+
+def _csrf_signature(session_id, timestamp):
+  message = '{}|{}'.format(session_id, timestamp).encode('utf-8')
+  return hmac.new(current_app.secret_key.encode('utf-8'), message, hashlib.sha256).hexdigest()
 
 def generate_csrf_token():
-  if '_csrf_token' not in session:
-    session['_csrf_token'] = token_generator()
-  return session['_csrf_token']
+  """stateless csrf token '<timestamp>.<hmac of session id and timestamp>'
+  Nothing is stored in the session, so rendering a form doesn't rewrite the
+  session cookie and any number of tabs can post with their own tokens.
+  A session without an id gets one here, a one-off session write: anonymous
+  visitors only on the pages that render a form (login, first use), users who
+  logged in before session ids existed on their next form.
+  """
+  session_id = session.get('sid')
+  if not session_id:
+    session_id = session['sid'] = new_session_id()
+  timestamp = int(time.time())
+  return '{}.{}'.format(timestamp, _csrf_signature(session_id, timestamp))
+
+def validate_csrf_token(token, max_age):
+  """True if token came from generate_csrf_token for this session less than max_age seconds ago"""
+  try:
+    timestamp, signature = token.split('.')
+    timestamp = int(timestamp)
+  except (AttributeError, ValueError):
+    return False
+  if not 0 <= time.time() - timestamp <= max_age:
+    return False
+  if not session.get('sid'):
+    # never given a form, nothing it could have been signed for
+    return False
+  expected = _csrf_signature(session['sid'], timestamp)
+  return hmac.compare_digest(expected.encode('ascii'), signature.encode('ascii', 'replace'))
 
 def login_required(f):
   @wraps(f)
@@ -42,11 +80,51 @@ def admin_required(f):
   return decorated_function
 
 
+def encode_cursor(row):
+  """opaque keyset cursor (created_on + id) for the position after row"""
+  return '{}-{}'.format(row.created_on.strftime(CURSOR_FORMAT), row.id)
+
+def decode_cursor(cursor):
+  """(created_on, id) from a cursor made by encode_cursor, None if malformed"""
+  try:
+    stamp, row_id = cursor.split('-')
+    return datetime.datetime.strptime(stamp, CURSOR_FORMAT), int(row_id)
+  except (AttributeError, ValueError):
+    return None
+
+def paginate_keyset(query, model, cursor=None, per_page=20, row=None):
+  """keyset ("seek") pagination, newest first on (created_on, id).
+  Unlike OFFSET the database seeks straight to the cursor through the
+  (created_on, id) index, so deep pages cost the same as the first one.
+  row, if given, builds each row from a tuple of the selected columns instead
+  of a model instance (it needs .id and .created_on for the cursor).
+  returns (rows, next_cursor), next_cursor is None on the last page.
+  """
+  query = query.order_by(model.created_on.desc(), model.id.desc())
+  position = decode_cursor(cursor)
+  if position:
+    query = query.where(Tuple(model.created_on, model.id) < Tuple(*position))
+  query = query.limit(per_page + 1)
+  rows = [row(values) for values in query.tuples()] if row else list(query)
+  next_cursor = None
+  if len(rows) > per_page:
+    rows = rows[:per_page]
+    next_cursor = encode_cursor(rows[-1])
+  return rows, next_cursor
+
+def row_to_dict(item, recurse=True):
+  """model_to_dict, with compressed columns (CompressedTextField) as their text"""
+  data = model_to_dict(item, recurse=recurse)
+  for name, value in data.items():
+    if isinstance(value, CompressedText):
+      data[name] = value.text()
+  return data
+
 def query_to_dict(query):
   """return a python dict from a query"""
   qdict = []
   for item in query:
-    qdict.append(model_to_dict(item))
+    qdict.append(row_to_dict(item))
   return qdict
     
 def query_to_json(query):
@@ -55,7 +133,6 @@ def query_to_json(query):
 
 def query_to_file(query, filename):
   """save query to file, basic name handling collision (PATH MUST EXIST)"""
-  data = query_to_dict(query)
   wfile = filename
   i = 0
   while True:
@@ -65,22 +142,429 @@ def query_to_file(query, filename):
     wfile = "{}.{}".format(filename, i)
     
   with open(wfile,"w") as fp:
-    fp.write(json.dumps(data, indent=4, sort_keys=True, default=str))
+    for chunk in query_to_chunks(query, ndjson=False):
+      fp.write(chunk)
+
+def query_to_chunks(query, ndjson=True, chunk_size=64 * 1024, extra=()):
+  """serialize a query as NDJSON (one object per line) or a JSON array.
+  Rows are read with query.iterator() and yielded as ~chunk_size strings,
+  so memory use stays flat no matter how big the table is.
+  Foreign keys are written as ids (no per-row lookups of related rows),
+  extra names attributes written along with the fields (e.g. joined columns).
+  """
+  buf, size = [] if ndjson else ['['], 0
+  for i, item in enumerate(query.iterator()):
+    record = row_to_dict(item, recurse=False)
+    for name in extra:
+      record[name] = getattr(item, name, None)
+    data = json.dumps(record, sort_keys=True, default=str)
+    if ndjson:
+      data += '\n'
+    else:
+      data = (',\n' if i else '\n') + data
+    buf.append(data)
+    size += len(data)
+    if size >= chunk_size:
+      yield ''.join(buf)
+      buf, size = [], 0
+  if not ndjson:
+    buf.append('\n]\n')
+  if buf:
+    yield ''.join(buf)
+
+def gzip_chunks(chunks, level=6):
+  """gzip a stream of string chunks incrementally (for streaming responses)"""
+  compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+  for chunk in chunks:
+    if not isinstance(chunk, bytes):
+      chunk = chunk.encode('utf-8')
+    data = compressor.compress(chunk)
+    if data:
+      yield data
+  yield compressor.flush()
     
+def iter_json_records(fp, chunk_size=64 * 1024):
+  """stream-parse exported records (see query_to_chunks) from a binary file.
+  Accepts NDJSON or a JSON array (indented or not), optionally gzipped, and
+  yields one dict at a time without reading the whole file into memory.
+  """
+  if fp.read(2) == b'\x1f\x8b':
+    fp.seek(0)
+    fp = gzip.GzipFile(fileobj=fp, mode='rb')
+  else:
+    fp.seek(0)
+  decoder = json.JSONDecoder()
+  utf8 = codecs.getincrementaldecoder('utf-8')()
+  buf, pos, eof = u'', 0, False
+  separators = u' \t\r\n,[]'
+  while True:
+    while pos < len(buf) and buf[pos] in separators:
+      pos += 1
+    try:
+      if pos == len(buf):
+        raise ValueError('need more data')
+      record, pos = decoder.raw_decode(buf, pos)
+    except ValueError:
+      if eof:
+        if pos < len(buf):
+          raise ValueError('malformed record at: {!r}'.format(buf[pos:pos + 40]))
+        return
+      data = fp.read(chunk_size)
+      eof = not data
+      buf = buf[pos:] + utf8.decode(data, final=eof)
+      pos = 0
+      continue
+    yield record
+
+def touch_stamp(path):
+  """bump a stamp file used to signal other processes that a cached value changed.
+  The file is replaced atomically, so its (inode, mtime) pair always changes
+  even when two writes land within the filesystem's timestamp resolution.
+  """
+  # a unique temp name, threads of one process may bump the same stamp at once
+  fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + '.', dir=os.path.dirname(path) or '.')
+  try:
+    with os.fdopen(fd, "w") as fp:
+      fp.write(repr(time.time()))
+    os.rename(tmp, path)
+  except:
+    os.remove(tmp)
+    raise
+
+def stamp_version(path):
+  """return a cheap version token for a stamp file (None if it doesn't exist)"""
+  try:
+    st = os.stat(path)
+  except OSError:
+    return None
+  return (st.st_ino, st.st_mtime)
+
+class QueryCounter(object):
+  """context manager that counts the SQL statements a peewee database runs,
+  handy in tests to catch N+1 regressions. With a limit it raises
+  AssertionError on exit when more statements than that were run.
+  
+  with QueryCounter(DB, limit=4) as counter:
+    client.get('/index')
+  """
+  def __init__(self, database, limit=None):
+    self.database = database
+    self.limit = limit
+    self.queries = []
+  
+  @property
+  def count(self):
+    return len(self.queries)
+  
+  def __enter__(self):
+    self._shadowed = vars(self.database).get('execute_sql')
+    original = self.database.execute_sql
+    def execute_sql(sql, params=None, *args, **kwargs):
+      self.queries.append(sql)
+      return original(sql, params, *args, **kwargs)
+    self.database.execute_sql = execute_sql
+    return self
+  
+  def __exit__(self, exc_type, exc_value, tb):
+    if self._shadowed is None:
+      del self.database.execute_sql
+    else:
+      self.database.execute_sql = self._shadowed
+    if exc_type is None and self.limit is not None and self.count > self.limit:
+      raise AssertionError("{} queries run, expected at most {}:\n{}".format(
+        self.count, self.limit, "\n".join(self.queries)))
+    return False
+
+
+class LRUCache(object):
+  """a small thread-safe least-recently-used cache holding at most max_size items.
+  
+  generation goes up whenever entries are dropped. Read it before loading what
+  a value is built from and pass it to set(), which then skips storing the
+  value if the cache was cleared in between (it may be built from stale data).
+  """
+  def __init__(self, max_size=500):
+    self.max_size = max_size
+    self.generation = 0
+    self._data = OrderedDict()
+    self._lock = threading.Lock()
+  
+  def get(self, key, default=None):
+    with self._lock:
+      try:
+        value = self._data.pop(key)
+      except KeyError:
+        return default
+      self._data[key] = value  # most recently used goes to the end
+      return value
+  
+  def set(self, key, value, generation=None):
+    """store value, unless generation is given and the cache was cleared since.
+    Returns whether it was stored."""
+    with self._lock:
+      if generation is not None and generation != self.generation:
+        return False
+      self._data.pop(key, None)
+      self._data[key] = value
+      while len(self._data) > self.max_size:
+        self._data.popitem(last=False)
+      return True
+  
+  def delete_where(self, predicate):
+    """remove every entry whose value satisfies predicate(value)"""
+    with self._lock:
+      self.generation += 1
+      for key in [k for k, v in self._data.items() if predicate(v)]:
+        del self._data[key]
+  
+  def clear(self):
+    with self._lock:
+      self.generation += 1
+      self._data.clear()
+  
+  def __len__(self):
+    return len(self._data)
 
-class MLStripper(HTMLParser):
-  def __init__(self):
-    self.reset()
-    self.fed = []
-  def handle_data(self, d):
-    self.fed.append(d)
-  def get_data(self):
-    return ''.join(self.fed)
+
+try:
+  _BLOB_TYPES = (bytes, bytearray, memoryview, buffer)
+except NameError:
+  _BLOB_TYPES = (bytes, bytearray, memoryview)
+
+class CompressedText(object):
+  """a compressed column value as read from the database, see CompressedTextField"""
+  __slots__ = ('blob',)
+  
+  def __init__(self, blob):
+    self.blob = blob
+  
+  def text(self):
+    codec, data = self.blob[:1], self.blob[1:]
+    if codec != b'z':
+      raise ValueError('unknown compression {!r}'.format(codec))
+    return zlib.decompress(data).decode('utf-8')
+  
+  def __repr__(self):
+    return 'CompressedText({!r})'.format(self.blob)
+
+
+class CompressedTextFieldDescriptor(FieldDescriptor):
+  """decompresses on first read of the attribute, not when the row is loaded"""
+  def __get__(self, instance, instance_type=None):
+    if instance is None:
+      return self.field
+    value = instance._data.get(self.att_name)
+    if isinstance(value, CompressedText):
+      value = instance._data[self.att_name] = value.text()
+    return value
+
+
+class CompressedTextField(TextField):
+  """TextField stored zlib compressed (a BLOB, tagged with its codec) once it
+  is threshold or more characters long; shorter text stays TEXT, so plain
+  and compressed rows mix in one column. With enabled False new values are
+  written plain, compressed rows are still read.
+  
+  Rows come back as CompressedText, model instances decompress them the first
+  time the attribute is read (rows loaded for a listing never are).
+  """
+  def __init__(self, threshold=1024, level=6, enabled=True, *args, **kwargs):
+    self.threshold = threshold
+    self.level = level
+    self.enabled = enabled
+    super(CompressedTextField, self).__init__(*args, **kwargs)
+  
+  def add_to_class(self, model_class, name):
+    super(CompressedTextField, self).add_to_class(model_class, name)
+    setattr(model_class, name, CompressedTextFieldDescriptor(self))
+  
+  def compress(self, text):
+    """the compressed bytes text is stored as, None if it's stored as it is"""
+    if text is None or not self.enabled or len(text) < self.threshold:
+      return None
+    return b'z' + zlib.compress(text.encode('utf-8'), self.level)
+  
+  def db_value(self, value):
+    if isinstance(value, CompressedText):
+      # loaded and never read, written back as it was
+      return sqlite3.Binary(value.blob)
+    text = super(CompressedTextField, self).db_value(value)
+    blob = self.compress(text)
+    return text if blob is None else sqlite3.Binary(blob)
+  
+  def python_value(self, value):
+    if isinstance(value, _BLOB_TYPES):
+      return CompressedText(bytes(value))
+    return value
+
+
+class FragmentCacheExtension(Extension):
+  """jinja tag keeping rendered template fragments in environment.fragment_cache
+  (anything with get/set, e.g. LRUCache; None renders without caching)
+  
+  {% cache 'navbar', session['is_admin'] %} ... {% endcache %}
+  
+  The values after the tag form the key, so a fragment is kept once for each
+  variant. Whatever else it shows has to be cleared from the cache by the app,
+  and environment.fragment_cache_generation (a callable) may return the cache's
+  generation from before the app read it, so a fragment rendered from values
+  read before a clear is not stored (see LRUCache.set).
+  """
+  tags = set(['cache'])
+  
+  def __init__(self, environment):
+    super(FragmentCacheExtension, self).__init__(environment)
+    environment.extend(fragment_cache=None, fragment_cache_generation=None)
+  
+  def parse(self, parser):
+    lineno = next(parser.stream).lineno
+    key = [parser.parse_expression()]
+    while parser.stream.skip_if('comma'):
+      key.append(parser.parse_expression())
+    body = parser.parse_statements(['name:endcache'], drop_needle=True)
+    return nodes.CallBlock(self.call_method('_cached', [nodes.Tuple(key, 'load')]),
+                           [], [], body).set_lineno(lineno)
+  
+  def _cached(self, key, caller):
+    cache = self.environment.fragment_cache
+    if cache is None:
+      return caller()
+    fragment = cache.get(key)
+    if fragment is None:
+      generation = None
+      if self.environment.fragment_cache_generation is not None:
+        generation = self.environment.fragment_cache_generation()
+      if generation is None:
+        generation = cache.generation
+      fragment = caller()
+      cache.set(key, fragment, generation)
+    return fragment
+
+
+class BackgroundJobs(object):
+  """runs functions on a small thread pool, so a request can hand off long
+  work and return at once. The pool starts on first use; a failing job
+  logs its error rather than taking the pool down.
+  """
+  def __init__(self, processes=1, logger=None):
+    self.processes = processes
+    self.logger = logger or logging.getLogger(__name__)
+    self._pool = None
+    self._lock = threading.Lock()
+  
+  def submit(self, func, *args):
+    with self._lock:
+      if self._pool is None:
+        self._pool = ThreadPool(self.processes)
+    return self._pool.apply_async(self._run, (func,) + args)
+  
+  def _run(self, func, *args):
+    try:
+      return func(*args)
+    except Exception:
+      self.logger.exception("background job %s failed", func.__name__)
+
+
+def hash_password(password, method, salt_length):
+  """werkzeug password hash made with method, e.g. 'pbkdf2:sha256:150000'"""
+  return generate_password_hash(password, method=method, salt_length=salt_length)
+
+def check_password(pwhash, password):
+  # hashes read back from sqlite are unicode, werkzeug on python 2 needs a str method name
+  return check_password_hash(str(pwhash), password)
+
+_method_prefixes = {}
+
+def password_needs_rehash(pwhash, method):
+  """True if pwhash was made with another method (or cost) than method.
+  Compared with the prefix werkzeug actually writes for method, which has the
+  defaults it fills in ('pbkdf2:sha256' is written 'pbkdf2:sha256:150000'),
+  found by hashing once per method.
+  """
+  if method not in _method_prefixes:
+    _method_prefixes[method] = generate_password_hash('', method=method).split('$', 1)[0]
+  return pwhash.split('$', 1)[0] != _method_prefixes[method]
+
+
+def take_token(tokens, updated, now, capacity, per_second):
+  """one token bucket step: refill for the time since updated, then take a token
+  returns (tokens left, seconds to wait), the wait is 0 when a token was taken
+  """
+  tokens = min(capacity, tokens + (now - updated) * per_second)
+  if tokens >= 1:
+    return tokens - 1, 0.0
+  return tokens, (1 - tokens) / per_second
+
+
+class TokenBuckets(object):
+  """in-process token buckets by key, e.g. login attempts per username.
+  A bucket holds up to capacity tokens and regains per_second tokens a second.
+  Past max_keys the least recently used buckets are forgotten (a forgotten
+  key starts over with a full bucket).
+  """
+  def __init__(self, capacity, per_second, max_keys=10000):
+    self.capacity = capacity
+    self.per_second = per_second
+    self.max_keys = max_keys
+    self._buckets = OrderedDict()
+    self._lock = threading.Lock()
+  
+  def take(self, key, now=None):
+    """take a token for key, returns 0 if there was one, else the seconds until there is"""
+    now = time.time() if now is None else now
+    with self._lock:
+      tokens, updated = self._buckets.pop(key, (self.capacity, now))
+      tokens, wait = take_token(tokens, updated, now, self.capacity, self.per_second)
+      self._buckets[key] = (tokens, now)
+      while len(self._buckets) > self.max_keys:
+        self._buckets.popitem(last=False)
+    return wait
+
+
+_TAGS = re.compile(r'<!--.*?-->|<(script|style)\b.*?</\1\s*>|<[^>]*>', re.S | re.I)
+_entities = HTMLParser()
 
 def strip_tags(html):
-  s = MLStripper()
-  s.feed(html)
-  return s.get_data()
+  """plain text from html: drops tags (a tag becomes a space, so paragraphs
+  don't run together), comments and script/style bodies and decodes entities.
+  One regex pass, much cheaper than feeding an HTMLParser."""
+  return _entities.unescape(_TAGS.sub(' ', html or ''))
+
+def summarize(text, length=100):
+  """first length characters of plain text, whitespace collapsed and cut
+  back to a word boundary when one is near"""
+  text = ' '.join(text.split())
+  if len(text) <= length:
+    return text
+  cut = text[:length]
+  space = cut.rfind(' ')
+  if space > length * 2 // 3:
+    cut = cut[:space]
+  return cut
+
+def fts_query(s):
+  """turn free text from a search box into a safe FTS5 MATCH expression.
+  Every word is quoted (so operators/punctuation can't cause syntax errors),
+  words are ANDed together and the last word is a prefix match.
+  >>> print fts_query('flask blo')
+  "flask" "blo"*
+  """
+  words = re.findall(r'\w+', s or '', re.UNICODE)
+  if not words:
+    return ''
+  terms = [u'"{}"'.format(w) for w in words]
+  terms[-1] += u'*'
+  return u' '.join(terms)
+
+def highlight(text, tag='mark'):
+  """jinja filter, escape a search excerpt and wrap the matched words
+  (delimited by \\x02 and \\x03 from the FTS snippet function) in <mark> tags
+  """
+  if not text:
+    return ''
+  text = escape(text)
+  return Markup(text.replace(u'\x02', Markup('<{}>'.format(tag)))
+                    .replace(u'\x03', Markup('</{}>'.format(tag))))
 
 def slugify(s):
   """
@@ -0,0 +1,37 @@
+"""production entry point, `python main.py` runs the single process development
+server instead. Serve wsgi:application with a multi-worker WSGI server:
+
+gunicorn -c gunicorn.conf.py wsgi:application
+
+gunicorn.conf.py runs several worker processes (one per core and then some,
+so requests aren't serialized on one GIL), each handling requests on a
+bounded pool of threads (SQLite and file reads release the GIL meanwhile).
+Suggested environment for that setup:
+
+BLOG_DB_PATH=/srv/blog/blog.db         database, its cache stamp files go next to it
+BLOG_UPLOAD_FOLDER=/srv/blog/uploads
+BLOG_DB_MODE=thread                    one connection per worker thread (the default)
+BLOG_LOGIN_LIMITER=db                  login throttling shared by all workers
+BLOG_PROXY_COUNT=1                     behind nginx etc., see below
+BLOG_TEMPLATE_CACHE=/srv/blog/jinja    template bytecode, `python main.py --compile-templates` fills it
+BLOG_COMPRESS=0                        only if the front-end server compresses responses itself
+
+Per-process caches (blog meta, rendered pages, slug map) are kept in step
+between the workers by the stamp files, and uploads are best handed to the
+front-end server (UPLOAD_SENDFILE in main.py).
+"""
+import os
+from main import app, compile_templates
+
+# number of reverse proxies in front of us, their X-Forwarded-For/-Proto are
+# trusted so request.remote_addr (login throttling) is the actual client
+PROXY_COUNT = int(os.environ.get('BLOG_PROXY_COUNT', 0))
+
+# every worker compiles (or loads from the bytecode cache) all templates now,
+# rather than during the first requests that use them
+compile_templates()
+
+application = app
+if PROXY_COUNT:
+  from werkzeug.middleware.proxy_fix import ProxyFix
+  application = ProxyFix(app, x_for=PROXY_COUNT, x_proto=PROXY_COUNT, x_host=PROXY_COUNT)